@@ -5,15 +5,23 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import hashlib # Use simple hashing
+import hmac
+import base64
+import json
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+import threading
+import time
+import asyncio
+import contextlib
+from cachetools import TTLCache
 
 # For Google/Facebook OAuth
 from authlib.integrations.starlette_client import OAuth
 from starlette.config import Config
 
 # For creating/decoding JWTs (JSON Web Tokens)
-from jose import jwt, JWTError
+from jose import JWTError
 
 # Importing schemas for token data
 from schemas import CustomerRead, RetailerRead, WholesalerRead
@@ -26,13 +34,18 @@ from config import SECRET_KEY, ALGORITHM
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
 # SMTP
-import random
-import string
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig , MessageType
+import secrets
+from fastapi_mail import MessageSchema, ConnectionConfig , MessageType
+from fastapi_mail.connection import Connection
+from fastapi_mail.msg import MailMsg
+from email.utils import formataddr
+import logging
 
 # OTP Authentication 
+# Generation is sub-microsecond, so no JIT is needed here. A single zero-padded
+# draw from the OS CSPRNG is both cheaper than joining 6 choices and unguessable.
 def generate_otp() -> str:
-    return "".join(random.choices(string.digits , k=6))
+    return f"{secrets.randbelow(1_000_000):06d}"
 
 mail_config = ConnectionConfig(
     MAIL_USERNAME = os.getenv("MAIL_USERNAME"),
@@ -46,6 +59,56 @@ mail_config = ConnectionConfig(
     VALIDATE_CERTS = True
 )
 
+mail_logger = logging.getLogger("livemart.mail")
+
+# Mails are queued (as a background task, after the response is sent) and delivered by a
+# few long-running workers. Each worker drains up to MAIL_BATCH_SIZE queued mails and sends
+# them over one SMTP connection, so a signup burst pays the TLS handshake + login once per
+# batch instead of once per mail. MAIL_WORKERS also caps how many connections are open.
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", 2))
+MAIL_BATCH_SIZE = 100
+_mail_queue: "asyncio.Queue[MessageSchema]" = asyncio.Queue()
+_mail_workers: list = []
+
+async def send_mail(message: MessageSchema):
+    _mail_queue.put_nowait(message)
+
+async def _deliver_mail_batch(batch: list):
+    sender = formataddr((mail_config.MAIL_FROM_NAME, mail_config.MAIL_FROM)) if mail_config.MAIL_FROM_NAME else mail_config.MAIL_FROM
+    async with Connection(mail_config) as conn:
+        for message in batch:
+            if mail_config.SUPPRESS_SEND: # test environments
+                continue
+            try:
+                await conn.session.send_message(await MailMsg(message)._message(sender))
+            except Exception:
+                mail_logger.exception("Failed to send mail %r to %s", message.subject, message.recipients)
+
+async def _mail_worker():
+    while True:
+        batch = [await _mail_queue.get()]
+        while len(batch) < MAIL_BATCH_SIZE and not _mail_queue.empty():
+            batch.append(_mail_queue.get_nowait())
+        try:
+            await _deliver_mail_batch(batch)
+        except Exception:
+            mail_logger.exception("SMTP connection failed, dropped %d mail(s)", len(batch))
+        finally:
+            for _ in batch:
+                _mail_queue.task_done()
+
+def start_mail_workers():
+    _mail_workers.extend(asyncio.create_task(_mail_worker()) for _ in range(MAIL_WORKERS))
+
+# Gives queued mails a chance to go out before shutdown, then stops the workers
+async def stop_mail_workers(timeout: float = 10):
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(_mail_queue.join(), timeout)
+    for task in _mail_workers:
+        task.cancel()
+    await asyncio.gather(*_mail_workers, return_exceptions=True)
+    _mail_workers.clear()
+
 async def send_otp_email(email: str , otp : str , background_tasks : BackgroundTasks):
     message = MessageSchema(
         subject="Live MART - Password Reset OTP" , 
@@ -60,8 +123,7 @@ async def send_otp_email(email: str , otp : str , background_tasks : BackgroundT
         subtype=MessageType.html
     )
 
-    fm = FastMail(mail_config)
-    background_tasks.add_task(fm.send_message , message)
+    background_tasks.add_task(send_mail, message)
 
 
 async def send_verification_email(email: str, otp: str, background_tasks: BackgroundTasks):
@@ -78,8 +140,7 @@ async def send_verification_email(email: str, otp: str, background_tasks: Backgr
         subtype=MessageType.html
     )
 
-    fm = FastMail(mail_config)
-    background_tasks.add_task(fm.send_message, message)
+    background_tasks.add_task(send_mail, message)
 
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
@@ -95,6 +156,14 @@ def hash_password(password: str):
 def verify_password(input_password: str , hashed_password: str):
     return hash_password(input_password) == hashed_password
 
+# Placeholder for accounts that never log in with a password (Google sign-in).
+# It is not a hex digest, so verify_password can never match it.
+def make_unverifiable_password():
+    return "!google-oauth!" + secrets.token_urlsafe(16)
+
+# Checked against when the login mail doesn't exist, so both failure paths cost the same
+DUMMY_PASSWORD_HASH = hash_password("x" * 16)
+
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -108,16 +177,104 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 1 day
 bearer_scheme = HTTPBearer()
 
 
+# Short-lived cache of authenticated users, keyed by (role, mail).
+# Saves the user SELECT on back-to-back requests from the same client; endpoints that
+# change a user row (profile updates, password reset) call invalidate_cached_user().
+USER_CACHE_TTL_SECONDS = 30
+_user_cache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+_user_cache_lock = threading.Lock() # Invalidation can come from threadpool endpoints
+
+async def _get_cached_user(role: str, mail: str, loader):
+    key = (role, mail)
+    with _user_cache_lock:
+        user = _user_cache.get(key)
+    if user is None:
+        user = await run_in_threadpool(loader, mail=mail)
+        if user is not None:
+            with _user_cache_lock:
+                _user_cache[key] = user
+    return user
+
+# HS256 verification without going through jose on every request.
+# The keyed HMAC state is built once and copied per token instead of re-deriving it from SECRET_KEY.
+_HMAC_PROTOTYPE = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256) if SECRET_KEY else None
+
+def _b64url_decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+def _b64url_encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+# Every token we issue has the same header, so its encoded segment is built once
+_JWT_HEADER_B64 = _b64url_encode(json.dumps({"alg": ALGORITHM, "typ": "JWT"}, separators=(",", ":")).encode())
+
+def _sign_hs256(claims: dict) -> str:
+    payload_b64 = _b64url_encode(json.dumps(claims, separators=(",", ":")).encode())
+    signing_input = f"{_JWT_HEADER_B64}.{payload_b64}"
+    mac = _HMAC_PROTOTYPE.copy()
+    mac.update(signing_input.encode())
+    return f"{signing_input}.{_b64url_encode(mac.digest())}"
+
+def _verify_hs256(token: str) -> dict:
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        header = json.loads(_b64url_decode(header_b64))
+        signature = _b64url_decode(signature_b64)
+    except ValueError:
+        raise JWTError("Malformed token")
+
+    # Reject anything we didn't issue before doing any crypto
+    if _HMAC_PROTOTYPE is None or not isinstance(header, dict) or header.get("alg") != ALGORITHM or header.get("typ", "JWT") != "JWT":
+        raise JWTError("Unsupported token header")
+
+    mac = _HMAC_PROTOTYPE.copy()
+    mac.update(f"{header_b64}.{payload_b64}".encode())
+    if not hmac.compare_digest(mac.digest(), signature):
+        raise JWTError("Signature verification failed")
+
+    try:
+        payload = json.loads(_b64url_decode(payload_b64))
+    except ValueError:
+        raise JWTError("Malformed token")
+    if not isinstance(payload, dict):
+        raise JWTError("Malformed token")
+
+    exp = payload.get("exp")
+    if exp is not None and (not isinstance(exp, (int, float)) or exp <= datetime.now(timezone.utc).timestamp()):
+        raise JWTError("Signature has expired")
+    return payload
+
+# Decoded claims keyed by sha256(token), so a warm client skips the JWT signature check too.
+# Entries never outlive the token's own "exp".
+_token_cache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+
+def _decode_token(token: str):
+    key = hashlib.sha256(token.encode()).digest()
+    with _user_cache_lock:
+        claims = _token_cache.get(key)
+    if claims is not None and claims[2] > datetime.now(timezone.utc).timestamp():
+        return claims[0], claims[1]
+
+    payload = _verify_hs256(token)
+    claims = (payload.get("sub"), payload.get("role"), payload.get("exp", 0))
+    with _user_cache_lock:
+        _token_cache[key] = claims
+    return claims[0], claims[1]
+
+def invalidate_cached_user(mail: str):
+    with _user_cache_lock:
+        for role in ("customer", "retailer", "wholesaler"):
+            _user_cache.pop((role, mail), None)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    if expires_delta is None:
+        expires_delta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    # Same claims jose would write ("exp" as integer seconds), signed with the prebuilt HMAC key
+    to_encode.update({"exp": int(time.time() + expires_delta.total_seconds())})
+    return _sign_hs256(to_encode)
 
 # Dependency to get the current logged-in customer
 async def get_current_customer(creds: HTTPAuthorizationCredentials = Depends(bearer_scheme)) -> Customer:
@@ -128,15 +285,13 @@ async def get_current_customer(creds: HTTPAuthorizationCredentials = Depends(bea
     )
     token = creds.credentials
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_mail: str = payload.get("sub")
-        user_role: str = payload.get("role")
+        user_mail, user_role = _decode_token(token)
         if user_mail is None or user_role != "customer":
             raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = await run_in_threadpool(get_customer_by_email, mail=user_mail) 
+    user = await _get_cached_user("customer", user_mail, get_customer_by_email)
     if user is None:
         raise credentials_exception
     return user
@@ -150,15 +305,13 @@ async def get_current_retailer(creds: HTTPAuthorizationCredentials = Depends(bea
     )
     token = creds.credentials
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_mail: str = payload.get("sub")
-        user_role: str = payload.get("role")
+        user_mail, user_role = _decode_token(token)
         if user_mail is None or user_role != "retailer":
             raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = await run_in_threadpool(get_retailer_by_email, mail=user_mail)
+    user = await _get_cached_user("retailer", user_mail, get_retailer_by_email)
     if user is None:
         raise credentials_exception
     return user
@@ -172,15 +325,13 @@ async def get_current_wholesaler(creds: HTTPAuthorizationCredentials = Depends(b
     )
     token = creds.credentials
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_mail: str = payload.get("sub")
-        user_role: str = payload.get("role")
+        user_mail, user_role = _decode_token(token)
         if user_mail is None or user_role != "wholesaler":
             raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = await run_in_threadpool(get_wholesaler_by_email, mail=user_mail)
+    user = await _get_cached_user("wholesaler", user_mail, get_wholesaler_by_email)
     if user is None:
         raise credentials_exception
     return user
@@ -217,8 +368,7 @@ async def send_admin_query_email(form_data: dict, background_tasks: BackgroundTa
         """,
         subtype=MessageType.html
     )
-    fm = FastMail(mail_config)
-    background_tasks.add_task(fm.send_message, message)
+    background_tasks.add_task(send_mail, message)
 
 
 
@@ -294,8 +444,7 @@ async def send_order_confirmation_email(
         subtype=MessageType.html
     )
     
-    fm = FastMail(mail_config)
-    background_tasks.add_task(fm.send_message, message)
+    background_tasks.add_task(send_mail, message)
 
 
 
@@ -350,5 +499,4 @@ async def send_status_update_email(
         subtype=MessageType.html
     )
     
-    fm = FastMail(mail_config)
-    background_tasks.add_task(fm.send_message, message)
\ No newline at end of file
+    background_tasks.add_task(send_mail, message)
\ No newline at end of file
@@ -1,9 +1,10 @@
 # Defining functions to create tables in backend
 
-from sqlmodel import SQLModel, create_engine, Session, select
-from typing import Optional, List, Dict, Any
+from sqlmodel import SQLModel, create_engine, Session, select, delete
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime, timedelta
 import os
+import logging
 
 # Import your models
 from db_models import (
@@ -20,11 +21,15 @@ from db_models import (
     WholesaleOrder,   
     WholesaleOrderItem,
     VerificationOTP,
+    PasswordReset,
     WholesalerProduct  # Added missing import
 )
 from schemas import OrderCreate, ProductUpdate, OrderStatusUpdate
 
 from fastapi import HTTPException, status
+from sqlalchemy import bindparam, update, insert, event, literal, union_all, exists, text, column, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 # -----------------------------------------------------------------
 # ABSOLUTE PATH SETUP (Guarantees backend/data/livemart.db)
@@ -38,106 +43,372 @@ if not os.path.exists(DATA_DIR):
 DB_FILE_PATH = os.path.join(DATA_DIR, "livemart.db")
 file_path = f"sqlite:///{DB_FILE_PATH}"
 
-engine = create_engine(file_path, echo=True, connect_args={"check_same_thread": False})
+# Pool sized for the threadpool (40 workers by default) rather than SQLAlchemy's 5 + 10.
+# A short pool_timeout turns pool exhaustion into a fast error instead of a 30 s stall.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 5))
+
+engine = create_engine(
+    file_path,
+    echo=True,
+    connect_args={"check_same_thread": False},
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=1800,
+    # Reuse the most recently returned connection, so a few warm connections (with their
+    # SQLite page cache) serve normal load and idle extras can age out via pool_recycle
+    pool_use_lifo=True
+)
+
+db_logger = logging.getLogger("livemart.db")
+
+# Per-connection SQLite settings, applied once when the pool opens a connection.
+# WAL lets readers run alongside the single writer, NORMAL sync is safe under WAL,
+# and an 8 MB page cache per connection keeps hot pages in memory. The pool can hold
+# up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections per worker, so keep this modest.
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 8_000))
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+# Warn when requests start needing overflow connections, before the pool actually runs out.
+# Once per overflow episode: re-armed by the first checkout after the pool drops back.
+_pool_overflow_logged = False
+
+@event.listens_for(engine, "checkout")
+def _log_pool_overflow(dbapi_connection, connection_record, connection_proxy):
+    global _pool_overflow_logged
+    in_overflow = engine.pool.overflow() > 0
+    if in_overflow and not _pool_overflow_logged:
+        db_logger.warning("DB pool in overflow: %s", engine.pool.status())
+    _pool_overflow_logged = in_overflow
+
+
+# -----------------------------------------------------------------
+# Precompiled Statements
+# -----------------------------------------------------------------
+STMT_WHOLESALE_ITEMS_BY_ORDER = select(WholesaleOrderItem).where(WholesaleOrderItem.wholesale_order_id == bindparam("oid"))
+# Ownership is part of the WHERE, and RETURNING hands back the updated order
+STMT_SET_WHOLESALE_ORDER_STATUS = (
+    update(WholesaleOrder)
+    .where(WholesaleOrder.id == bindparam("oid"), WholesaleOrder.wholesaler_id == bindparam("wid"))
+    .values(status=bindparam("new_status"))
+    .returning(WholesaleOrder)
+)
+# Matches only on the transition into "Shipped", which is what triggers the retailer restock
+STMT_SHIP_WHOLESALE_ORDER = STMT_SET_WHOLESALE_ORDER_STATUS.where(WholesaleOrder.status != "Shipped")
+STMT_VERIFICATION_OTP_BY_EMAIL_OTP = select(VerificationOTP).where(
+    VerificationOTP.email == bindparam("email"),
+    VerificationOTP.otp == bindparam("otp")
+)
+# Verification applies to every role registered under the mail, one UPDATE per table
+STMTS_MARK_VERIFIED_BY_MAIL = [
+    update(model).where(model.mail == bindparam("email")).values(is_verified=True)
+    for model in (Customer, Retailer, Wholesaler)
+]
+# Replaces any pending OTP for the email in one statement (email is unique on passwordreset)
+_UPSERT_PASSWORD_RESET = sqlite_insert(PasswordReset).values(
+    email=bindparam("to_email"), otp=bindparam("new_otp"), expires_at=bindparam("new_expiry")
+)
+STMT_UPSERT_PASSWORD_RESET = _UPSERT_PASSWORD_RESET.on_conflict_do_update(
+    index_elements=["email"],
+    set_={"otp": _UPSERT_PASSWORD_RESET.excluded.otp, "expires_at": _UPSERT_PASSWORD_RESET.excluded.expires_at}
+)
+STMT_DELETE_VERIFICATION_OTPS_BY_EMAIL = delete(VerificationOTP).where(VerificationOTP.email == bindparam("email"))
+
+# Hot per-request lookups (auth + cart)
+STMT_CUSTOMER_BY_MAIL = select(Customer).where(Customer.mail == bindparam("mail"))
+STMT_RETAILER_BY_MAIL = select(Retailer).where(Retailer.mail == bindparam("mail"))
+STMT_WHOLESALER_BY_MAIL = select(Wholesaler).where(Wholesaler.mail == bindparam("mail"))
+# Which role (if any) owns an email, in one round-trip instead of three lookups.
+# "priority" keeps the old customer -> retailer -> wholesaler precedence when an email has several roles.
+STMT_ACCOUNT_BY_MAIL = union_all(
+    *(
+        select(literal(priority).label("priority"), literal(role).label("role"), model.id, model.is_verified)
+        .where(model.mail == bindparam("mail"))
+        for priority, role, model in ((0, "customer", Customer), (1, "retailer", Retailer), (2, "wholesaler", Wholesaler))
+    )
+).order_by("priority").limit(1)
+STMT_CART_BY_CUSTOMER = select(ShoppingCart).where(ShoppingCart.customer_id == bindparam("cid"))
+# Decrements stock only if enough is left; rowcount 0 means the product sold out meanwhile
+STMT_TAKE_STOCK = (
+    update(Product)
+    .where(Product.id == bindparam("pid"))
+    .where(Product.stock >= bindparam("qty"))
+    .values(stock=Product.stock - bindparam("qty"))
+)
+
+# Checkout reads the customer's cart items with their products in one query.
+# Outer join, so an item whose product was removed still shows up and can be reported.
+_CART_ID_BY_CUSTOMER = select(ShoppingCart.id).where(ShoppingCart.customer_id == bindparam("cid")).scalar_subquery()
+STMT_CHECKOUT_ITEMS = select(ShoppingCartItem, Product).outerjoin(
+    Product, ShoppingCartItem.product_id == Product.id
+).where(ShoppingCartItem.cart_id == _CART_ID_BY_CUSTOMER)
+# GET /cart keys the item list straight off the customer, so the cart row isn't read first.
+# Only the item's id and quantity are needed, so the cart item is projected as two columns
+# and just the Product gets hydrated as an ORM entity
+STMT_DETAILED_CART_ITEMS_BY_CUSTOMER = select(
+    ShoppingCartItem.id.label("cart_item_id"), ShoppingCartItem.quantity, Product
+).where(
+    ShoppingCartItem.cart_id == _CART_ID_BY_CUSTOMER
+).join(Product, ShoppingCartItem.product_id == Product.id)
+STMT_CLEAR_CART_BY_CUSTOMER = delete(ShoppingCartItem).where(ShoppingCartItem.cart_id == _CART_ID_BY_CUSTOMER)
+STMT_COUNT_PURCHASE = (
+    update(Customer)
+    .where(Customer.id == bindparam("cid"))
+    .values(no_of_purchases=Customer.no_of_purchases + 1)
+)
 
 
 # -----------------------------------------------------------------
 # Creating Tables
 # -----------------------------------------------------------------
 
+# Older builds looked a cart up and created it in two separate steps, so a database can
+# hold several carts per customer, which blocks the unique customer_id index. Each
+# customer's extra carts are folded into their oldest one before the indexes are built.
+MERGE_DUPLICATE_CARTS = [
+    """UPDATE shoppingcartitem SET cart_id = (
+        SELECT MIN(keep.id) FROM shoppingcart AS keep
+        JOIN shoppingcart AS dup ON dup.customer_id = keep.customer_id
+        WHERE dup.id = shoppingcartitem.cart_id
+    ) WHERE cart_id IN (
+        SELECT id FROM shoppingcart WHERE id NOT IN (SELECT MIN(id) FROM shoppingcart GROUP BY customer_id)
+    )""",
+    "DELETE FROM shoppingcart WHERE id NOT IN (SELECT MIN(id) FROM shoppingcart GROUP BY customer_id)",
+]
+
+# OTP rows are disposable: keep only the newest one per email, so passwordreset.email
+# can be made unique (the forgot-password upsert's ON CONFLICT target)
+DELETE_DUPLICATE_PASSWORD_RESETS = """DELETE FROM passwordreset WHERE id NOT IN (
+    SELECT MAX(id) FROM passwordreset GROUP BY email
+)"""
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
 
+    with engine.begin() as connection:
+        for statement in MERGE_DUPLICATE_CARTS:
+            connection.execute(text(statement))
+        connection.execute(text(DELETE_DUPLICATE_PASSWORD_RESETS))
+        # Superseded by the unique email index; only cost writes on older databases
+        connection.execute(text("DROP INDEX IF EXISTS ix_passwordreset_email_otp"))
+
+    # create_all() skips tables that already exist, so indexes added to the models
+    # later would never reach an existing livemart.db. Create any missing ones here.
+    # A unique index that existing rows violate (e.g. the same mail registered twice)
+    # is skipped with an error instead of stopping the app from starting.
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except IntegrityError:
+                db_logger.error("Could not create %s: duplicate rows in %s", index.name, table.name)
+
+    # The same goes for an index that later became unique (ON CONFLICT needs it to be):
+    # rebuild it in one transaction, so duplicates that block it leave the old one in place.
+    inspector = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {ix["name"]: bool(ix["unique"]) for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.unique and existing.get(index.name) is False:
+                try:
+                    with engine.begin() as connection:
+                        index.drop(connection)
+                        index.create(connection)
+                except IntegrityError:
+                    db_logger.warning("Could not make %s unique: duplicate rows in %s", index.name, table.name)
+
+    create_product_search_index()
+
 
 # -----------------------------------------------------------------
-# Customer Functions
+# Product Text Search
 # -----------------------------------------------------------------
-def add_customer(name: str, mail: str, hashed_password: str, delivery_address: str = None, city: str = None, state: str = None, pincode: str = None, phone_number: str = None, profile_pic: str = None, lat: float = None, lon: float = None):
-    with Session(engine) as session:
-        customer = Customer(
-            name=name, 
-            mail=mail, 
-            hashed_password=hashed_password, 
-            delivery_address=delivery_address,
-            city=city,
-            state=state,
-            pincode=pincode,
-            phone_number=phone_number,
-            profile_pic=profile_pic,
-            lat=lat,
-            lon=lon
-        )
-        session.add(customer)
-        session.commit()
-        session.refresh(customer)
-        return customer
 
-def get_customer_by_email(mail: str):
+# '%q%' LIKE on name/description can't use a B-tree index, so search goes through
+# an FTS5 trigram table instead (SQLite's counterpart of a pg_trgm index).
+# It is an external-content table over product, kept in sync by triggers.
+PRODUCT_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(
+        name, description, content='product', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE OF name, description ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+]
+
+# Trigrams need at least 3 characters; shorter terms fall back to LIKE
+PRODUCT_FTS_MIN_TERM = 3
+
+STMT_PRODUCT_IDS_MATCHING = text(
+    "SELECT rowid FROM product_fts WHERE product_fts MATCH :term"
+).columns(column("rowid"))
+
+
+def create_product_search_index():
+    with engine.begin() as conn:
+        exists_already = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'product_fts'"
+        ).first()
+        for ddl in PRODUCT_FTS_DDL:
+            conn.exec_driver_sql(ddl)
+        # Rows that existed before the triggers did have to be indexed once
+        if not exists_already:
+            conn.exec_driver_sql("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+
+
+# Quotes the search term as one FTS5 phrase so user input can't inject query syntax
+def product_search_term(q: str) -> str:
+    return '"' + q.replace('"', '""') + '"'
+
+
+# Request-scoped session for endpoints: Depends(get_session)
+def get_session():
     with Session(engine) as session:
-        statement = select(Customer).where(Customer.mail == mail)
-        return session.exec(statement).first()
+        yield session
+
 
 # -----------------------------------------------------------------
-# Retailer Functions
+# Customer Functions
 # -----------------------------------------------------------------
-def add_retailer(name: str, mail: str, hashed_password: str, business_name: str, address: str, city: str, state: str, pincode: str, phone_number: str = None, tax_id: str = None, profile_pic: str = None, business_logo: str = None, lat: float = None, lon: float = None):
-    with Session(engine) as session:
-        retailer = Retailer(
-            name=name,
-            mail=mail,
-            hashed_password=hashed_password,
-            business_name=business_name,
-            address=address,
-            city=city,
-            state=state,
-            pincode=pincode,
-            phone_number=phone_number,
-            tax_id=tax_id,
-            profile_pic=profile_pic,
-            business_logo=business_logo,
-            lat=lat,
-            lon=lon
-        )
-        session.add(retailer)
+
+# Inserts a new Customer / Retailer / Wholesaler in one statement.
+# Returns None if the mail is already registered for that role (unique index on mail),
+# so callers don't need a separate "email exists" SELECT first.
+# A verification_otp is stored in the same transaction, so signup is one threadpool hop.
+def _insert_user_if_new(user, verification_otp: Optional[str] = None):
+    model = type(user)
+    statement = (
+        sqlite_insert(model)
+        .values(**user.model_dump(exclude={"id"}))
+        .on_conflict_do_nothing(index_elements=["mail"])
+        .returning(model)
+    )
+    with Session(engine, expire_on_commit=False) as session:
+        created = session.execute(statement).scalars().first()
+        if created is not None and verification_otp is not None:
+            _replace_verification_otp(session, created.mail, verification_otp)
         session.commit()
-        session.refresh(retailer)
-        return retailer
+        return created
+
+# Google sign-in: creates the customer already verified, or verifies an existing one,
+# in a single INSERT ... ON CONFLICT(mail) DO UPDATE ... RETURNING
+def upsert_verified_customer(name: str, mail: str, hashed_password: str) -> Customer:
+    customer = Customer(name=name, mail=mail, hashed_password=hashed_password, is_verified=True)
+    statement = (
+        sqlite_insert(Customer)
+        .values(**customer.model_dump(exclude={"id"}))
+        .on_conflict_do_update(index_elements=["mail"], set_={"is_verified": True})
+        .returning(Customer)
+    )
+    with Session(engine, expire_on_commit=False) as session:
+        upserted = session.execute(statement).scalars().one()
+        session.commit()
+        return upserted
+
+def add_customer(name: str, mail: str, hashed_password: str, delivery_address: str = None, city: str = None, state: str = None, pincode: str = None, phone_number: str = None, profile_pic: str = None, lat: float = None, lon: float = None, verification_otp: str = None):
+    customer = Customer(
+        name=name, 
+        mail=mail, 
+        hashed_password=hashed_password, 
+        delivery_address=delivery_address,
+        city=city,
+        state=state,
+        pincode=pincode,
+        phone_number=phone_number,
+        profile_pic=profile_pic,
+        lat=lat,
+        lon=lon
+    )
+    return _insert_user_if_new(customer, verification_otp)
+
+# Pass an open session to reuse it across several lookups in one request
+def get_customer_by_email(mail: str, session: Optional[Session] = None):
+    if session is None:
+        with Session(engine) as session:
+            return get_customer_by_email(mail, session)
+    return session.exec(STMT_CUSTOMER_BY_MAIL, params={"mail": mail}).first()
 
-def get_retailer_by_email(mail: str):
-    with Session(engine) as session:
-        statement = select(Retailer).where(Retailer.mail == mail)
-        return session.exec(statement).first()
+# -----------------------------------------------------------------
+# Retailer Functions
+# -----------------------------------------------------------------
+def add_retailer(name: str, mail: str, hashed_password: str, business_name: str, address: str, city: str, state: str, pincode: str, phone_number: str = None, tax_id: str = None, profile_pic: str = None, business_logo: str = None, lat: float = None, lon: float = None, verification_otp: str = None):
+    retailer = Retailer(
+        name=name,
+        mail=mail,
+        hashed_password=hashed_password,
+        business_name=business_name,
+        address=address,
+        city=city,
+        state=state,
+        pincode=pincode,
+        phone_number=phone_number,
+        tax_id=tax_id,
+        profile_pic=profile_pic,
+        business_logo=business_logo,
+        lat=lat,
+        lon=lon
+    )
+    return _insert_user_if_new(retailer, verification_otp)
+
+# Pass an open session to reuse it across several lookups in one request
+def get_retailer_by_email(mail: str, session: Optional[Session] = None):
+    if session is None:
+        with Session(engine) as session:
+            return get_retailer_by_email(mail, session)
+    return session.exec(STMT_RETAILER_BY_MAIL, params={"mail": mail}).first()
 
 # -----------------------------------------------------------------
 # Wholesaler Functions
 # -----------------------------------------------------------------
-def add_wholesaler(name: str, mail: str, hashed_password: str, business_name: str, address: str, city: str, state: str, pincode: str, phone_number: str = None, tax_id: str = None, profile_pic: str = None, business_logo: str = None, lat: float = None, lon: float = None):
-    with Session(engine) as session:
-        wholesaler = Wholesaler(
-            name=name,
-            mail=mail,
-            hashed_password=hashed_password,
-            business_name=business_name,
-            address=address,
-            city=city,
-            state=state,
-            pincode=pincode,
-            phone_number=phone_number,
-            tax_id=tax_id,
-            profile_pic=profile_pic,
-            business_logo=business_logo,
-            lat=lat,
-            lon=lon
-        )
-        session.add(wholesaler)
-        session.commit()
-        session.refresh(wholesaler)
-        return wholesaler
-
-def get_wholesaler_by_email(mail: str):
-    with Session(engine) as session:
-        statement = select(Wholesaler).where(Wholesaler.mail == mail)
-        return session.exec(statement).first()
+def add_wholesaler(name: str, mail: str, hashed_password: str, business_name: str, address: str, city: str, state: str, pincode: str, phone_number: str = None, tax_id: str = None, profile_pic: str = None, business_logo: str = None, lat: float = None, lon: float = None, verification_otp: str = None):
+    wholesaler = Wholesaler(
+        name=name,
+        mail=mail,
+        hashed_password=hashed_password,
+        business_name=business_name,
+        address=address,
+        city=city,
+        state=state,
+        pincode=pincode,
+        phone_number=phone_number,
+        tax_id=tax_id,
+        profile_pic=profile_pic,
+        business_logo=business_logo,
+        lat=lat,
+        lon=lon
+    )
+    return _insert_user_if_new(wholesaler, verification_otp)
+
+# Pass an open session to reuse it across several lookups in one request
+def get_wholesaler_by_email(mail: str, session: Optional[Session] = None):
+    if session is None:
+        with Session(engine) as session:
+            return get_wholesaler_by_email(mail, session)
+    return session.exec(STMT_WHOLESALER_BY_MAIL, params={"mail": mail}).first()
+
+# Returns a row with .role, .id and .is_verified, or None if no account uses this email
+def find_account_by_email(mail: str, session: Optional[Session] = None):
+    if session is None:
+        with Session(engine) as session:
+            return find_account_by_email(mail, session)
+    return session.exec(STMT_ACCOUNT_BY_MAIL, params={"mail": mail}).first()
 
 # -----------------------------------------------------------------
 # Product & Category Functions
@@ -150,21 +421,34 @@ def add_category(name: str, description: str, image_url: str):
         session.refresh(category)
         return category
 
+# INSERT ... RETURNING gives back the whole row, so no refresh SELECT after the commit
 def add_product(name: str, price: float, stock: int, retailer_id: int, description: str, category_id: int, image_url: str):
+    product = Product(
+        name=name,
+        price=price,
+        stock=stock,
+        retailer_id=retailer_id,
+        description=description,
+        category_id=category_id,
+        image_url=image_url
+    )
+    with Session(engine, expire_on_commit=False) as session:
+        created = session.scalars(
+            insert(Product).values(**product.model_dump(exclude={"id"})).returning(Product)
+        ).one()
+        session.commit()
+        return created
+
+# Batch version for imports/seeding: one executemany INSERT and one commit for all rows.
+# Returns the new ids in the same order as 'rows'.
+def add_products_bulk(rows: List[Dict[str, Any]]) -> List[int]:
     with Session(engine) as session:
-        product = Product(
-            name=name,
-            price=price,
-            stock=stock,
-            retailer_id=retailer_id,
-            description=description,
-            category_id=category_id,
-            image_url=image_url
-        )
-        session.add(product)
+        ids = session.scalars(
+            insert(Product).returning(Product.id, sort_by_parameter_order=True),
+            [Product(**row).model_dump(exclude={"id"}) for row in rows]
+        ).all()
         session.commit()
-        session.refresh(product)
-        return product
+        return ids
 
 def get_all_products(category: str = None) -> List[Product]:
     with Session(engine) as session:
@@ -174,46 +458,65 @@ def get_all_products(category: str = None) -> List[Product]:
             statement = select(Product)
         return session.exec(statement).all()
 
-def get_product_by_id(product_id: int):
-    with Session(engine) as session:
-        return session.get(Product, product_id)
-
-def get_products_by_retailer(retailer_id: int) -> List[Product]:
+# Newest first; limit/cursor give keyset pages (id < cursor) for large inventories
+def get_products_by_retailer(retailer_id: int, limit: Optional[int] = None, cursor: Optional[int] = None) -> List[Product]:
     with Session(engine) as session:
         statement = select(Product).where(Product.retailer_id == retailer_id)
+        if cursor is not None:
+            statement = statement.where(Product.id < cursor)
+        statement = statement.order_by(Product.id.desc())
+        if limit is not None:
+            statement = statement.limit(limit)
         return session.exec(statement).all()
 
-def update_product_details(product: Product, update_data: ProductUpdate) -> Product:
-    with Session(engine) as session:
-        # Note: 'product' here is detached if passed from main.py directly.
-        # Re-fetch to be safe
-        db_product = session.get(Product, product.id)
-        if not db_product: return None
+# Lookup, ownership check and update in one session, so the endpoint makes a single threadpool hop
+def update_retailer_product(product_id: int, retailer_id: int, update_data: ProductUpdate) -> Product:
+    with Session(engine, expire_on_commit=False) as session:
+        db_product = session.get(Product, product_id)
+        if not db_product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        if db_product.retailer_id != retailer_id:
+            raise HTTPException(status_code=403, detail="Not authorized to update this product")
 
-        update_dict = update_data.model_dump(exclude_unset=True)
-        for key, value in update_dict.items():
+        for key, value in update_data.model_dump(exclude_unset=True).items():
             setattr(db_product, key, value)
-        
-        session.add(db_product)
+
         session.commit()
-        session.refresh(db_product)
         return db_product
 
 # -----------------------------------------------------------------
 # Cart Functions
 # -----------------------------------------------------------------
-def create_cart_for_customer(customer_id: int):
-    with Session(engine) as session:
-        cart = ShoppingCart(customer_id=customer_id)
-        session.add(cart)
+# Lookup + create-if-missing in one call, so callers pay a single threadpool hop.
+# Reads first (the common case takes no write lock); the insert is ON CONFLICT DO NOTHING,
+# so two first requests racing for the same customer still end up with one cart.
+def get_or_create_cart(customer_id: int, session: Optional[Session] = None) -> ShoppingCart:
+    if session is None:
+        with Session(engine, expire_on_commit=False) as session:
+            return get_or_create_cart(customer_id, session)
+
+    cart = session.exec(STMT_CART_BY_CUSTOMER, params={"cid": customer_id}).first()
+    if not cart:
+        cart = session.execute(
+            sqlite_insert(ShoppingCart)
+            .values(customer_id=customer_id)
+            .on_conflict_do_nothing(index_elements=["customer_id"])
+            .returning(ShoppingCart)
+        ).scalars().first()
         session.commit()
-        session.refresh(cart) 
-        return cart
-
-def get_cart_by_customer_id(customer_id: int):
-    with Session(engine) as session:
-        statement = select(ShoppingCart).where(ShoppingCart.customer_id == customer_id)
-        return session.exec(statement).first()
+        if not cart: # Lost the race, the other request's cart is there now
+            cart = session.exec(STMT_CART_BY_CUSTOMER, params={"cid": customer_id}).first()
+    return cart
+
+# Everything GET /cart needs from one query: items come keyed by customer and the total
+# size is summed from them. The cart row is only touched (and created if missing) when
+# the list comes back empty.
+def get_cart_with_items(customer_id: int):
+    with Session(engine, expire_on_commit=False) as session:
+        items = _cart_item_dicts(session.exec(STMT_DETAILED_CART_ITEMS_BY_CUSTOMER, params={"cid": customer_id}))
+        if not items:
+            get_or_create_cart(customer_id, session)
+        return items, sum(item["quantity"] for item in items)
 
 def get_cart_items(cart_id: int):
     with Session(engine) as session:
@@ -222,25 +525,26 @@ def get_cart_items(cart_id: int):
         ).all()
         return items
 
-def get_detailed_cart_items(cart_id: int) -> List[dict]:
-    with Session(engine) as session:
-        statement = select(ShoppingCartItem, Product).where(
-            ShoppingCartItem.cart_id == cart_id
-        ).join(Product, ShoppingCartItem.product_id == Product.id)
-        
-        results = session.exec(statement).all()
-        
-        detailed_items = []
-        for cart_item, product in results:
-            detailed_items.append({
-                "cart_item_id": cart_item.id,
-                "quantity": cart_item.quantity,
-                "product": product
-            })
-        return detailed_items
-
-def add_item_to_cart(product_id: int, quantity: int, cart_id: int, customer_id: int = None):
+def _cart_item_dicts(rows) -> List[dict]:
+    return [
+        {
+            "cart_item_id": cart_item_id,
+            "quantity": quantity,
+            "product": product
+        }
+        for cart_item_id, quantity, product in rows
+    ]
+
+# Pass cart_id, or customer_id to resolve the cart in the same session as the
+# product read, stock check and write (one threadpool hop, one connection).
+def add_item_to_cart(product_id: int, quantity: int, cart_id: int = None, customer_id: int = None):
     with Session(engine) as session:
+        if cart_id is None:
+            cart = session.exec(STMT_CART_BY_CUSTOMER, params={"cid": customer_id}).first()
+            if not cart:
+                raise HTTPException(status_code=404, detail="Customer cart not found")
+            cart_id = cart.id
+
         product = session.get(Product, product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
@@ -278,6 +582,55 @@ def add_item_to_cart(product_id: int, quantity: int, cart_id: int, customer_id:
         
         return None
 
+# Batched add_item_to_cart: one product query, one cart-item query and one commit for the lot.
+# Same rules per product as add_item_to_cart (quantities merge, <= 0 removes the item).
+def add_items_to_cart(cart_id: int, items: List[Dict[str, int]]) -> List[ShoppingCartItem]:
+    requested: Dict[int, int] = {}
+    for item in items:
+        requested[item["product_id"]] = requested.get(item["product_id"], 0) + item["quantity"]
+    if not requested:
+        return []
+
+    with Session(engine) as session:
+        product_ids = list(requested)
+        products = {p.id: p for p in session.exec(select(Product).where(Product.id.in_(product_ids)))}
+        existing = {
+            ci.product_id: ci for ci in session.exec(
+                select(ShoppingCartItem)
+                .where(ShoppingCartItem.cart_id == cart_id)
+                .where(ShoppingCartItem.product_id.in_(product_ids))
+            )
+        }
+
+        saved = []
+        for product_id, quantity in requested.items():
+            product = products.get(product_id)
+            if not product:
+                raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
+
+            cart_item = existing.get(product_id)
+            new_quantity = quantity + (cart_item.quantity if cart_item else 0)
+
+            if new_quantity <= 0:
+                if cart_item:
+                    session.delete(cart_item)
+                continue
+
+            if product.stock < new_quantity:
+                raise HTTPException(status_code=400, detail=f"Not enough stock for {product.name}. Available: {product.stock}")
+
+            if cart_item:
+                cart_item.quantity = new_quantity
+            else:
+                cart_item = ShoppingCartItem(product_id=product_id, quantity=new_quantity, cart_id=cart_id)
+            session.add(cart_item)
+            saved.append(cart_item)
+
+        session.commit()
+        for cart_item in saved:
+            session.refresh(cart_item)
+        return saved
+
 def get_cart_size(cart_id: int):
     items = get_cart_items(cart_id)      
     size = 0
@@ -288,103 +641,109 @@ def get_cart_size(cart_id: int):
 # -----------------------------------------------------------------
 # Order Functions (FIXED)
 # -----------------------------------------------------------------
-def process_checkout(customer: Customer, order_details: OrderCreate) -> OrderRecords:
+# Returns the order and its (OrderItem, product_name) lines, so the caller can build the
+# confirmation email without reading the order back
+def process_checkout(customer: Customer, order_details: OrderCreate) -> Tuple[OrderRecords, List[tuple]]:
+    # Everything below is one transaction: any HTTPException rolls back the whole checkout.
+    # The statement count is fixed (read, stock, order, items, clear, stats) whatever the cart size.
     with Session(engine) as session:
-        # 1. Get Cart
-        cart = session.exec(select(ShoppingCart).where(ShoppingCart.customer_id == customer.id)).first()
-        if not cart:
-            raise HTTPException(status_code=404, detail="Customer cart not found")
-            
-        cart_items = session.exec(select(ShoppingCartItem).where(ShoppingCartItem.cart_id == cart.id)).all()
-        if not cart_items:
+        # 1. Cart items and their products in one query
+        rows = session.exec(STMT_CHECKOUT_ITEMS, params={"cid": customer.id}).all()
+        if not rows:
+            if session.exec(STMT_CART_BY_CUSTOMER, params={"cid": customer.id}).first() is None:
+                raise HTTPException(status_code=404, detail="Customer cart not found")
             raise HTTPException(status_code=400, detail="Cart is empty")
 
-        total_price = 0.0
-        products_to_update = []
-        order_items_to_create = []
-
-        # 2. Calc Total & Check Stock
-        for item in cart_items:
-            product = session.get(Product, item.product_id)
-            if not product:
+        for item, product in rows:
+            if product is None:
                 raise HTTPException(status_code=404, detail=f"Product with ID {item.product_id} no longer exists")
-            
-            if product.stock < item.quantity:
-                raise HTTPException(status_code=400, detail=f"Not enough stock for {product.name}. Available: {product.stock}")
-            
-            product.stock -= item.quantity
-            products_to_update.append(product)
-            
-            price_at_purchase = product.price
-            total_price += price_at_purchase * item.quantity
-            
-            order_items_to_create.append(
-                OrderItem(
-                    product_id=product.id,
-                    quantity=item.quantity,
-                    price_at_purchase=price_at_purchase
-                )
-            )
 
-        # 3. Create Order
-        new_order = OrderRecords(
-            customer_id=customer.id,
-            shipping_address=order_details.shipping_address,
-            shipping_city=order_details.shipping_city,
-            shipping_pincode=order_details.shipping_pincode,
-            total_price=total_price,
-            payment_mode=order_details.payment_mode,
-            payment_status="Pending"
+        # 2. Take stock for every line in one executemany. Each UPDATE is conditional, so
+        # concurrent checkouts can't oversell; a short rowcount means some line ran out.
+        taken = session.connection().execute(
+            STMT_TAKE_STOCK, [{"pid": item.product_id, "qty": item.quantity} for item, _ in rows]
         )
-        session.add(new_order)
-        session.commit()
-        session.refresh(new_order)
-        
-        # 4. Link Order Items
-        for oi in order_items_to_create:
-            oi.orderrecords_id = new_order.id
-            session.add(oi)
-            
-        # 5. Update Stock
-        for prod in products_to_update:
-            session.add(prod)
-            
-        # 6. Clear Cart
-        for item in cart_items:
-            session.delete(item)
-            
-        # 7. Update Customer Stats
-        # --- FIX: Use a FRESH instance to update DB, keeping original safe ---
-        db_customer = session.get(Customer, customer.id)
-        if db_customer:
-            db_customer.no_of_purchases += 1
-            session.add(db_customer)
+        if taken.rowcount != len(rows):
+            session.rollback()
+            stock_now = {p.id: p.stock for p in session.exec(select(Product).where(Product.id.in_([i.product_id for i, _ in rows])))}
+            short = next(((p.name, stock_now.get(p.id, 0)) for i, p in rows if stock_now.get(p.id, 0) < i.quantity), None)
+            if short:
+                raise HTTPException(status_code=400, detail=f"Not enough stock for {short[0]}. Available: {short[1]}")
+            raise HTTPException(status_code=409, detail="Stock changed during checkout, please try again")
+
+        # 3. Create the order; RETURNING hands back the full row, no refresh needed
+        total_price = sum(product.price * item.quantity for item, product in rows)
+        new_order = session.scalars(
+            insert(OrderRecords).values(
+                customer_id=customer.id,
+                order_date=datetime.utcnow(),
+                status="Pending",
+                shipping_address=order_details.shipping_address,
+                shipping_city=order_details.shipping_city,
+                shipping_pincode=order_details.shipping_pincode,
+                total_price=total_price,
+                payment_mode=order_details.payment_mode,
+                payment_status="Pending"
+            ).returning(OrderRecords)
+        ).one()
+
+        # 4. Order items, priced at purchase time, in one executemany
+        order_items = [
+            OrderItem(
+                orderrecords_id=new_order.id,
+                product_id=product.id,
+                quantity=item.quantity,
+                price_at_purchase=product.price
+            )
+            for item, product in rows
+        ]
+        session.execute(insert(OrderItem), [order_item.model_dump(exclude={"id"}) for order_item in order_items])
+        # Names are read now: after commit the products are expired and each would reload
+        purchased = [(order_item, product.name) for order_item, (_, product) in zip(order_items, rows)]
 
-        session.commit()
-        session.refresh(new_order)
-        
-        # Do NOT refresh 'customer' here, it is detached and fine for main.py
-        
-        return new_order
+        # 5. Clear Cart
+        session.exec(STMT_CLEAR_CART_BY_CUSTOMER, params={"cid": customer.id})
 
-def get_order_by_id(order_id: int) -> Optional[OrderRecords]:
-    with Session(engine) as session:
-        return session.get(OrderRecords, order_id)
+        # 6. Update Customer Stats
+        # Increment in SQL; the 'customer' passed in is detached and stays untouched
+        session.exec(STMT_COUNT_PURCHASE, params={"cid": customer.id})
 
-def update_order_status(order: OrderRecords, status_update: OrderStatusUpdate) -> OrderRecords:
-    with Session(engine) as session:
-        # Re-fetch to ensure attachment
-        db_order = session.get(OrderRecords, order.id)
-        if not db_order: return None
+        # Detach first, so commit doesn't expire the row RETURNING already filled in
+        session.expunge(new_order)
+        session.commit()
+        
+        return new_order, purchased
+
+# The order, only if it contains at least one of this retailer's products (else None).
+# OrderRecords has no retailer column, so ownership goes through OrderItem -> Product.
+def _retailer_order_statement(order_id: int, retailer_id: int):
+    owns_item = exists().where(
+        OrderItem.orderrecords_id == OrderRecords.id,
+        OrderItem.product_id == Product.id,
+        Product.retailer_id == retailer_id
+    )
+    return select(OrderRecords).where(OrderRecords.id == order_id, owns_item)
+
+# Ownership check, status update and (if the status changed) the customer lookup for the
+# notification email, all in one session. Returns None if the order isn't the retailer's,
+# else (order, old_status, customer); customer is None when the status didn't change.
+def update_order_for_retailer(order_id: int, retailer_id: int, status_update: OrderStatusUpdate):
+    with Session(engine, expire_on_commit=False) as session:
+        db_order = session.exec(_retailer_order_statement(order_id, retailer_id)).first()
+        if not db_order:
+            return None
 
+        old_status = db_order.status
         db_order.status = status_update.status
         if status_update.payment_status:
             db_order.payment_status = status_update.payment_status
-        
-        session.add(db_order)
+
+        customer = None
+        if db_order.status != old_status:
+            customer = session.get(Customer, db_order.customer_id)
+
         session.commit()
-        session.refresh(db_order)
-        return db_order
+        return db_order, old_status, customer
 
 def get_orders_by_retailer(retailer_id: int):
     with Session(engine) as session:
@@ -401,61 +760,132 @@ def get_orders_by_retailer(retailer_id: int):
 # -----------------------------------------------------------------
 # Feedback & Wholesale Functions
 # -----------------------------------------------------------------
-def add_feedback(product_id: int, customer_id: int, rating: int, comment: str):
-    with Session(engine) as session:
-        fb = Feedback(product_id=product_id, customer_id=customer_id, rating=rating, comment=comment)
-        session.add(fb)
-        session.commit()
-        return fb
+# Pass an open session to add many reviews (or wholesale orders, below) under one
+# commit; the caller then commits. Without one, a session is opened and committed here.
+def add_feedback(product_id: int, customer_id: int, rating: int, comment: str, session: Optional[Session] = None):
+    if session is None:
+        with Session(engine, expire_on_commit=False) as session:
+            fb = add_feedback(product_id, customer_id, rating, comment, session)
+            session.commit()
+            return fb
+    fb = Feedback(product_id=product_id, customer_id=customer_id, rating=rating, comment=comment)
+    session.add(fb)
+    return fb
+
+# The order comes back from INSERT ... RETURNING (no commit + refresh to get its id),
+# then every line goes in with a single executemany
+def add_wholesale_order(retailer_id: int, wholesaler_id: int, address: str, items: list, session: Optional[Session] = None):
+    if session is None:
+        with Session(engine, expire_on_commit=False) as session:
+            w_order = add_wholesale_order(retailer_id, wholesaler_id, address, items, session)
+            session.commit()
+            return w_order
 
-def add_wholesale_order(retailer_id: int, wholesaler_id: int, address: str, items: list):
-    with Session(engine) as session:
-        total_price = sum(item['product'].price * item['quantity'] for item in items) * 0.7 
-        
-        w_order = WholesaleOrder(
+    total_price = sum(item['product'].price * item['quantity'] for item in items) * 0.7 
+    
+    w_order = session.scalars(
+        insert(WholesaleOrder).values(
             retailer_id=retailer_id,
             wholesaler_id=wholesaler_id,
+            order_date=datetime.utcnow(),
             status="Processing",
             total_price=total_price,
             delivery_address=address
-        )
-        session.add(w_order)
-        session.commit()
-        session.refresh(w_order)
-        
-        for item in items:
-            wo_item = WholesaleOrderItem(
-                wholesale_order_id=w_order.id,
-                product_id=item['product'].id,
-                quantity=item['quantity'],
-                price_per_unit=item['product'].price * 0.7
-            )
-            session.add(wo_item)
-        session.commit()
-        return w_order
+        ).returning(WholesaleOrder)
+    ).one()
     
+    if items:
+        session.execute(insert(WholesaleOrderItem), [
+            {
+                "wholesale_order_id": w_order.id,
+                "product_id": item['product'].id,
+                "quantity": item['quantity'],
+                "price_per_unit": item['product'].price * 0.7
+            }
+            for item in items
+        ])
+    return w_order
+    
+def apply_wholesale_order_status(order_id: int, wholesaler_id: int, new_status: str) -> WholesaleOrder:
+    # expire_on_commit=False keeps the RETURNING columns usable after commit,
+    # so the order is returned without a refresh() round-trip
+    with Session(engine, expire_on_commit=False) as session:
+        shipping = new_status == "Shipped"
+        statement = STMT_SHIP_WHOLESALE_ORDER if shipping else STMT_SET_WHOLESALE_ORDER_STATUS
+        order = session.scalars(statement, {"oid": order_id, "wid": wholesaler_id, "new_status": new_status}).first()
+
+        if order is None:
+            # Nothing updated: the order is missing, someone else's, or already Shipped
+            order = session.get(WholesaleOrder, order_id)
+            if not order: raise HTTPException(status_code=404, detail="Order not found")
+            if order.wholesaler_id != wholesaler_id: raise HTTPException(status_code=403, detail="Not authorized")
+            return order
+
+        # --- STATUS LOGIC ---
+        # If changing to "Shipped", add stock to Retailer
+        if shipping:
+            items = session.exec(STMT_WHOLESALE_ITEMS_BY_ORDER, params={"oid": order.id}).all()
+
+            for item in items:
+                # Find product details from Wholesaler Inventory
+                ws_product = session.get(WholesalerProduct, item.product_id)
+                if not ws_product: continue
+
+                # Check if Retailer already has this product
+                retailer_product = session.exec(
+                    select(Product)
+                    .where(Product.retailer_id == order.retailer_id)
+                    .where(Product.name == ws_product.name)
+                ).first()
+
+                if retailer_product:
+                    retailer_product.stock += item.quantity
+                    session.add(retailer_product)
+                else:
+                    # Create new product for Retailer
+                    new_prod = Product(
+                        name=ws_product.name,
+                        price=ws_product.price * 1.2, # Default 20% markup
+                        stock=item.quantity,
+                        retailer_id=order.retailer_id,
+                        description="Sourced from Wholesaler",
+                        category_id=1,
+                        image_url=ws_product.image_url
+                    )
+                    session.add(new_prod)
+
+        session.commit()
+        return order
+
 # -----------------------------------------------------------------
 # Verification Functions
 # -----------------------------------------------------------------
 
-def save_verification_otp(email: str, otp: str):
+def _replace_verification_otp(session: Session, email: str, otp: str):
     expiration = datetime.utcnow() + timedelta(minutes=30)
+    # Drop any previous OTPs for this email in one statement
+    session.exec(STMT_DELETE_VERIFICATION_OTPS_BY_EMAIL, params={"email": email})
+    session.add(VerificationOTP(email=email, otp=otp, expires_at=expiration))
+
+def save_verification_otp(email: str, otp: str):
     with Session(engine) as session:
-        existing = session.exec(select(VerificationOTP).where(VerificationOTP.email == email)).all()
-        for record in existing:
-            session.delete(record)
-            
-        new_otp = VerificationOTP(email=email, otp=otp, expires_at=expiration)
-        session.add(new_otp)
+        _replace_verification_otp(session, email, otp)
         session.commit()
 
-def verify_user_account(email: str, otp: str) -> bool:
+def mark_user_verified(model, user_id: int):
+    # model is one of Customer / Retailer / Wholesaler
+    # One conditional UPDATE; already-verified users are left untouched
     with Session(engine) as session:
-        statement = select(VerificationOTP).where(      
-            (VerificationOTP.email == email) & 
-            (VerificationOTP.otp == otp)
+        session.exec(
+            update(model)
+            .where(model.id == user_id, model.is_verified == False)
+            .values(is_verified=True)
         )
-        record = session.exec(statement).first()
+        session.commit()
+
+def verify_user_account(email: str, otp: str) -> bool:
+    with Session(engine) as session:
+        record = session.exec(STMT_VERIFICATION_OTP_BY_EMAIL_OTP, params={"email": email, "otp": otp}).first()
 
         if not record: return False
         
@@ -464,28 +894,37 @@ def verify_user_account(email: str, otp: str) -> bool:
             session.commit()
             return False
 
-        user_found = False
-        customer = session.exec(select(Customer).where(Customer.mail == email)).first()
-        if customer:
-            customer.is_verified = True
-            session.add(customer)
-            user_found = True
-            
-        retailer = session.exec(select(Retailer).where(Retailer.mail == email)).first()
-        if retailer:
-            retailer.is_verified = True
-            session.add(retailer)
-            user_found = True
-                
-        wholesaler = session.exec(select(Wholesaler).where(Wholesaler.mail == email)).first()
-        if wholesaler:
-            wholesaler.is_verified = True
-            session.add(wholesaler)
-            user_found = True
+        # rowcount counts matched rows, so it tells us whether any account uses this mail
+        user_found = sum(session.exec(stmt, params={"email": email}).rowcount for stmt in STMTS_MARK_VERIFIED_BY_MAIL)
 
         if user_found:
             session.delete(record)
             session.commit()
             return True
             
-        return False
\ No newline at end of file
+        return False
+
+
+# -----------------------------------------------------------------
+# Password Reset Functions
+# -----------------------------------------------------------------
+
+def save_password_reset_otp(email: str, otp: str) -> bool:
+    # User lookup (all three roles) and the OTP write share one session.
+    # Returns False when no account uses this email.
+    expiration = datetime.utcnow() + timedelta(minutes=10) # OTP is valid for 10min
+    with Session(engine) as session:
+        if not find_account_by_email(email, session):
+            return False
+
+        # Insert the OTP, or overwrite the earlier request's row: one INSERT ... ON CONFLICT
+        session.exec(STMT_UPSERT_PASSWORD_RESET, params={"to_email": email, "new_otp": otp, "new_expiry": expiration})
+        session.commit()
+        return True
+
+def delete_expired_password_resets() -> int:
+    # One DELETE for every expired OTP, run periodically from the app lifespan
+    with Session(engine) as session:
+        result = session.exec(delete(PasswordReset).where(PasswordReset.expires_at < datetime.utcnow()))
+        session.commit()
+        return result.rowcount
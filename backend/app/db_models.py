@@ -41,7 +41,7 @@ class Customer(SQLModel , table=True):
 
     # Personal Details
     name: str
-    mail: str
+    mail: str = Field(index=True, unique=True) # Signup relies on this for ON CONFLICT
     hashed_password: str  # Hashed password for secure authenticaion
     profile_pic : Optional[str] = Field(default=default_pfp_path)
 
@@ -75,7 +75,7 @@ class Retailer(SQLModel , table=True):
     id: Optional[int] = Field(default=None , primary_key=True)
 
     name: str
-    mail : str
+    mail : str = Field(index=True, unique=True) # Signup relies on this for ON CONFLICT
     hashed_password : str
     profile_pic : Optional[str] = Field(default=default_pfp_path)
 
@@ -113,7 +113,7 @@ class Wholesaler(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
 
     name: str
-    mail: str
+    mail: str = Field(index=True, unique=True) # Signup relies on this for ON CONFLICT
     hashed_password: str
     profile_pic : Optional[str] = Field(default=default_pfp_path)
 
@@ -153,7 +153,7 @@ class WholesaleOrder(SQLModel, table=True):
     retailer_id: int = Field(foreign_key="retailer.id")
     
     # Wholesaler --> Seller
-    wholesaler_id: int = Field(foreign_key="wholesaler.id")
+    wholesaler_id: int = Field(foreign_key="wholesaler.id", index=True)
     
     order_date: datetime = Field(default_factory=datetime.utcnow, nullable=False)
     status: str = Field(default="Pending") # "Pending", "Approved", "Shipped"
@@ -166,7 +166,7 @@ class WholesaleOrder(SQLModel, table=True):
 # --- Wholesaler Specific Inventory ---
 class WholesalerProduct(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    wholesaler_id: int = Field(foreign_key="wholesaler.id")
+    wholesaler_id: int = Field(foreign_key="wholesaler.id", index=True)
     name: str
     price: float  # Bulk price per unit
     stock: int    # Total units available
@@ -182,7 +182,7 @@ class WholesalerProduct(SQLModel, table=True):
 class WholesaleOrderItem(SQLModel, table=True):
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    wholesale_order_id: int = Field(foreign_key="wholesaleorder.id")
+    wholesale_order_id: int = Field(foreign_key="wholesaleorder.id", index=True)
     
     # This could link to the main Product table OR a separate WholesalerProduct table
     # For simplicity in your project, let's link to a main product.
@@ -216,7 +216,7 @@ class Product(SQLModel , table=True):
     image_url: Optional[str] = Field(default=default_product_image)
     cart_items: List["ShoppingCartItem"] = Relationship(back_populates="product")
     # Linking product to retailer who sells it
-    retailer_id : int = Field(foreign_key="retailer.id")
+    retailer_id : int = Field(foreign_key="retailer.id", index=True)
 
 
 
@@ -236,8 +236,8 @@ class ShoppingCart(SQLModel , table=True):
 
     id: Optional[int] = Field(default=None , primary_key=True)
     items: List["ShoppingCartItem"] = Relationship(back_populates="shopping_cart")
-    # Refers to the Customer using this cart
-    customer_id: int = Field(foreign_key="customer.id")
+    # Refers to the Customer using this cart (one cart per customer; get_or_create_cart relies on it)
+    customer_id: int = Field(foreign_key="customer.id", index=True, unique=True)
 
 
 
@@ -252,7 +252,7 @@ class ShoppingCartItem(SQLModel , table = True):
     quantity: int
 
     # Refers to the shopping cart the item belongs to
-    cart_id: int = Field(foreign_key="shoppingcart.id")
+    cart_id: int = Field(foreign_key="shoppingcart.id", index=True)
     # Relationships:
     # 1. Relation to Product (Required for the ShoppingCartItemRead schema)
     product: "Product" = Relationship(back_populates="cart_items")
@@ -269,7 +269,7 @@ class ShoppingCartItem(SQLModel , table = True):
 class OrderRecords(SQLModel , table=True):
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    customer_id: int = Field(foreign_key="customer.id")
+    customer_id: int = Field(foreign_key="customer.id", index=True)
 
     order_date : datetime = Field (default_factory=datetime.utcnow , nullable=False)
     status: str = Field(default="Pending")
@@ -290,7 +290,7 @@ class OrderRecords(SQLModel , table=True):
 class OrderItem(SQLModel, table=True):
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    orderrecords_id: int = Field(foreign_key="orderrecords.id")
+    orderrecords_id: int = Field(foreign_key="orderrecords.id", index=True)
     product_id: int = Field(foreign_key="product.id")
     quantity: int
     
@@ -306,7 +306,7 @@ class OrderItem(SQLModel, table=True):
 class Feedback(SQLModel, table=True):
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    product_id: int = Field(foreign_key="product.id")
+    product_id: int = Field(foreign_key="product.id", index=True)
     customer_id: int = Field(foreign_key="customer.id")
     
     rating: int # A rating, e.g., 1-5 stars
@@ -321,8 +321,11 @@ class Feedback(SQLModel, table=True):
 # --------------------------------------------------------------------------------------------------------------------
 
 class PasswordReset(SQLModel , table=True):
+    # Every OTP endpoint looks rows up by email or (email, otp). Only one pending OTP is
+    # kept per email, so the unique email index already pins down the row for both.
+
     id : Optional[int] = Field(default=None , primary_key=True)
-    email: str = Field(index=True)
+    email: str = Field(index=True, unique=True)
     otp:str
     expires_at : datetime
     
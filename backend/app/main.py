@@ -1,26 +1,42 @@
 # App
 
 # Importing FastAPI
-from fastapi import FastAPI , HTTPException , status, Depends, Form , BackgroundTasks,UploadFile,File
+from fastapi import FastAPI , HTTPException , status, Depends, Form , BackgroundTasks,UploadFile,File, Query
 
 from typing import List, Annotated, Optional 
-from pydantic import BaseModel 
+from pydantic import BaseModel, TypeAdapter
 import shutil 
 import uuid 
+from pathlib import PurePosixPath
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 
 from sqlmodel import Session, select, or_ , col
-from contextlib import asynccontextmanager
+from sqlalchemy import bindparam, tuple_, update, insert, lambda_stmt
+from contextlib import asynccontextmanager, suppress
+import asyncio
+import anyio
+import hashlib
+import threading
+import orjson
+from cachetools import TTLCache
 
 from fastapi.concurrency import run_in_threadpool
 
 # Add datetime for Google Auth
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from starlette.middleware.sessions import SessionMiddleware
+from brotli_asgi import BrotliMiddleware
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
 from starlette.requests import Request
 from starlette.responses import RedirectResponse
 import os
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -29,10 +45,15 @@ from pydantic import BaseModel # Importing BaseModel for the new Verification Sc
 from auth import (
     hash_password, 
     verify_password, 
+    make_unverifiable_password,
     create_access_token, 
     get_current_retailer,
     get_current_customer,
     get_current_wholesaler,
+    invalidate_cached_user,
+    DUMMY_PASSWORD_HASH,
+    start_mail_workers,
+    stop_mail_workers,
 
     oauth, # Google OAuth
 
@@ -50,32 +71,42 @@ from auth import (
 # Importing custom-built database models and functions
 from database import (
     create_db_and_tables,
+    PRODUCT_FTS_MIN_TERM,
+    STMT_PRODUCT_IDS_MATCHING,
+    product_search_term,
     add_customer,
     add_product,
     add_retailer,
     add_wholesaler,
-    create_cart_for_customer,
+    get_or_create_cart,
+    get_cart_with_items,
+    find_account_by_email,
     add_item_to_cart,
+    add_items_to_cart,
     get_cart_items,
     get_cart_size,
     get_customer_by_email,
     get_retailer_by_email,
     get_wholesaler_by_email,
-    get_cart_by_customer_id,
-    get_detailed_cart_items,
+    get_session,
     process_checkout,
     get_products_by_retailer,
-    get_product_by_id,
-    update_product_details,
+    update_retailer_product,
     get_orders_by_retailer,
-    get_order_by_id,
-    update_order_status,
+    update_order_for_retailer,
     
     # Verification Database Functions
     save_verification_otp, # <--- NEW
     verify_user_account,   # <--- NEW
-
-    engine
+    delete_expired_password_resets,
+    save_password_reset_otp,
+    mark_user_verified,
+    upsert_verified_customer,
+    apply_wholesale_order_status,
+
+    engine,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW
 )
 
 # Importing the SQLModel classes
@@ -100,30 +131,200 @@ from db_models import (Customer,
 # Importing the Schemas
 from schemas import *
 
-# Image Management
-import shutil
-from fastapi import File , UploadFile
 # -----------------------------
 # Building the App
 # -----------------------------
 
+# -----------------------------
+# Logging
+# -----------------------------
+# Request handlers only push records onto an in-memory queue; a QueueListener thread
+# does the actual stderr writes, so error paths (e.g. checkout) never block on I/O.
+logger = logging.getLogger("livemart")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+log_listener = QueueListener(_log_queue, _log_handler)
+
+
+# Expired password-reset OTPs are swept periodically so the table stays small
+OTP_PURGE_INTERVAL_SECONDS = 5 * 60
+
+async def purge_expired_otps():
+    while True:
+        try:
+            await run_in_threadpool(delete_expired_password_resets)
+        except Exception:
+            logger.exception("OTP purge failed")
+        await asyncio.sleep(OTP_PURGE_INTERVAL_SECONDS)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    log_listener.start()
     create_db_and_tables()
+    # run_in_threadpool workers are what hold DB connections, so keep both limits in step
+    anyio.to_thread.current_default_thread_limiter().total_tokens = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    logger.info("DB pool ready: %s", engine.pool.status())
+    purge_task = asyncio.create_task(purge_expired_otps())
+    start_mail_workers()
     yield
-
+    # Shutdown
+    await stop_mail_workers()
+    purge_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await purge_task
+    log_listener.stop()
+
+# ORJSONResponse is used as the default encoder (much faster than the stdlib json for big lists)
 app = FastAPI(
     title="Live MART" , 
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 SECRET_KEY = os.getenv("SECRET_KEY", "unsafe-random-string-for-dev")
-app.add_middleware(SessionMiddleware , secret_key = SECRET_KEY)
+
+# Only the Google OAuth round trip (state/nonce) uses request.session; everything else is JWT.
+# Skip the cookie signing/verification on all other paths.
+OAUTH_SESSION_PATHS = ("/login/google", "/auth/google")
+
+class OAuthSessionMiddleware(SessionMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] not in OAUTH_SESSION_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(OAuthSessionMiddleware , secret_key = SECRET_KEY)
+
+# Brotli (gzip fallback) for JSON/HTML; images are already compressed, so they're skipped
+COMPRESS_MINIMUM_SIZE = 512
+app.add_middleware(
+    BrotliMiddleware,
+    quality=4,
+    minimum_size=COMPRESS_MINIMUM_SIZE,
+    excluded_handlers=[r"^/product_images/", r"^/profile_pictures/"]
+)
+
+# Per-IP rate limiting (currently only the login endpoints).
+# The default memory:// storage counts per worker process; point RATE_LIMIT_STORAGE_URI
+# at a shared store (e.g. redis://localhost:6379) to enforce one limit across workers.
+LOGIN_RATE_LIMIT = "10/minute"
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
-# Mounting the app to folder at "../data"
-# app.mount("/static" , StaticFiles(directory="../data") , name="static") # Removed relative path causing issues
+# -----------------------------
+# Precompiled Statements
+# -----------------------------
+# Built once at import and reused with bound parameters, so the hot endpoints
+# below always hit SQLAlchemy's compiled statement cache instead of rebuilding
+# the select() tree on every request.
+
+# Projects only the 5 columns the map needs instead of loading full Retailer rows
+STMT_RETAILER_LOCATIONS = select(
+    Retailer.id, Retailer.business_name, Retailer.lat, Retailer.lon, Retailer.address
+).where(Retailer.lat.is_not(None), Retailer.lon.is_not(None))
+
+STMT_WHOLESALE_ORDERS_BY_WID = select(WholesaleOrder).where(
+    WholesaleOrder.wholesaler_id == bindparam("wid"),
+    WholesaleOrder.status.in_(["Pending", "Processing"])
+).order_by(WholesaleOrder.order_date.desc())
+
+STMT_WHOLESALE_HISTORY_BY_WID = select(WholesaleOrder).where(
+    WholesaleOrder.wholesaler_id == bindparam("wid"),
+    WholesaleOrder.status.in_(["Shipped", "Delivered", "Approved"])
+).order_by(WholesaleOrder.order_date.desc())
+
+STMT_RESET_BY_EMAIL_OTP = select(PasswordReset).where(
+    PasswordReset.email == bindparam("email"),
+    PasswordReset.otp == bindparam("otp")
+)
+
+# One UPDATE per role table; the same mail may be registered under several roles
+STMTS_SET_PASSWORD_BY_MAIL = [
+    update(model).where(model.mail == bindparam("email")).values(hashed_password=bindparam("hashed"))
+    for model in (Customer, Retailer, Wholesaler)
+]
+
+STMT_ORDERS_BY_CUSTOMER = select(OrderRecords).where(
+    OrderRecords.customer_id == bindparam("cid")
+).order_by(OrderRecords.order_date.desc())
+
+STMT_ORDER_ITEMS_WITH_NAME = select(OrderItem, Product.name).join(
+    Product, Product.id == OrderItem.product_id
+).where(OrderItem.orderrecords_id == bindparam("oid"))
+
+# All orders containing a retailer's products, one row per order line.
+# Only the 7 columns the frontend shows are selected (no ORM entities), labelled with its keys.
+# We join OrderItem -> Product -> OrderRecords -> Customer
+STMT_CUSTOMER_HISTORY_BY_RETAILER = select(
+    OrderRecords.id.label("order_id"),
+    OrderRecords.order_date.label("date"),
+    Customer.name.label("customer_name"),
+    Customer.mail.label("customer_email"),
+    Product.name.label("product_name"),
+    OrderItem.quantity.label("quantity"),
+    (OrderItem.price_at_purchase * OrderItem.quantity).label("total_paid")
+).join(
+    OrderItem, OrderItem.orderrecords_id == OrderRecords.id
+).join(
+    Product, Product.id == OrderItem.product_id
+).join(
+    Customer, Customer.id == OrderRecords.customer_id
+).where(Product.retailer_id == bindparam("rid")).order_by(OrderRecords.order_date.desc())
+
+STMT_WHOLESALE_INVENTORY_BY_WID = select(WholesalerProduct).where(
+    WholesalerProduct.wholesaler_id == bindparam("wid")
+)
+
+STMT_FEEDBACK_BY_PRODUCT = select(Feedback, Customer.name).join(
+    Customer, Customer.id == Feedback.customer_id
+).where(Feedback.product_id == bindparam("pid")).order_by(Feedback.created_at.desc())
+
+STMT_FEEDBACK_BY_RETAILER = select(Feedback, Product.name, Customer.name).join(
+    Product, Product.id == Feedback.product_id
+).join(
+    Customer, Customer.id == Feedback.customer_id
+).where(Product.retailer_id == bindparam("rid")).order_by(Feedback.created_at.desc())
+
+
+# -----------------------------
+# Keyset Pagination
+# -----------------------------
+# List endpoints take optional ?limit=&cursor=. Without limit they return everything, as the
+# dashboards expect. The body stays a plain list; when more rows may follow, the id to
+# pass as the next cursor goes in the X-Next-Cursor header.
+MAX_PAGE_SIZE = 200
+
+def next_page_cursor(rows, limit):
+    if limit is None or len(rows) < limit:
+        return None
+    return rows[-1].id
+
+def page_headers(next_cursor):
+    return {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else None
+
+
+# -----------------------------
+# Trusted Responses
+# -----------------------------
+# Rows we just wrote/read are already valid, so build the Read schema with model_construct
+# (no validation) and send it directly. response_model on the route stays for the docs.
+def trusted_response(schema, obj, status_code: int = 200) -> ORJSONResponse:
+    data = schema.model_construct(**{field: getattr(obj, field) for field in schema.model_fields})
+    return ORJSONResponse(content=data.model_dump(), status_code=status_code)
+
+
+# Static files are mounted at the bottom of this file (absolute paths, after all API routes)
 
 # Creating endpoints
 
@@ -146,15 +347,11 @@ async def signup_customer(
     background_tasks: BackgroundTasks # <--- NEW: Required for sending email
 ):
 
-    # Check if email already exists
-    exists = await run_in_threadpool(get_customer_by_email, customer.mail)
-
-    if exists:
-        raise HTTPException(status_code=400 , detail="Email Already Registered")
-
     # Hashing the password
     hashed_password = hash_password(customer.password)
 
+    # The OTP is stored in the same transaction as the new account
+    otp = generate_otp()
     new_customer = await run_in_threadpool(
         add_customer,
         customer.name,
@@ -166,47 +363,48 @@ async def signup_customer(
         customer.pincode,
         customer.phone_number,
         lat=customer.lat,
-        lon=customer.lon
+        lon=customer.lon,
+        verification_otp=otp
     )
 
-    # If customer not created
+    # add_customer skips the insert when the email already exists
     if not new_customer:
-        raise HTTPException(status_code=500 , detail="Failed to create Customer. Oops, Try again!")
+        raise HTTPException(status_code=400 , detail="Email Already Registered")
 
     # --- NEW: Send Verification OTP ---
-    otp = generate_otp()
-    await run_in_threadpool(save_verification_otp, customer.mail, otp)
     await send_verification_email(customer.mail, otp, background_tasks)
     # ----------------------------------
 
     # Used Custom Read to serialize response (orm_mode = True)
-    return new_customer 
+    return trusted_response(CustomerRead, new_customer, status.HTTP_201_CREATED)
 
 # -------------------------------------------------------------------------------------------------------------------------------------------------
 
 # Login Endpoint - POST ---> Accepts JSON Body
 @app.post("/login/customer", response_model=Token, tags=["Customer Auth"])
+@limiter.limit(LOGIN_RATE_LIMIT)
 async def login_customer(
+    request: Request,
     req: LoginRequest
 ):
 
     # Checking if customer exists
     customer = await run_in_threadpool(get_customer_by_email , req.mail)
 
-    if not customer:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED , detail="Invalid Credentials: Mail not found")
+    # Same work and same error whether the mail or the password is wrong
+    password_ok = verify_password(req.password, customer.hashed_password if customer else DUMMY_PASSWORD_HASH)
+    if not customer or not password_ok:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED , detail="Invalid Credentials")
     
     # --- NEW: Verify if account is active ---
     if not customer.is_verified:
         raise HTTPException(status_code=403, detail="Account not verified. Please verify your email.")
     # ----------------------------------------
-
-    # Checking password
-    # Password incorrect
-    if not verify_password(req.password, customer.hashed_password):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED , detail="Invalid Credentials: Password not found")
     
     # Create and return JWT token
+    # Fresh login always reloads the user row on the next authenticated call
+    invalidate_cached_user(customer.mail)
+
     access_token = create_access_token(data={"sub": customer.mail, "role": "customer"})
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -224,7 +422,7 @@ class CustomerNameUpdate(BaseModel):
     name: str
 
 @app.patch("/customer/me/update", response_model=CustomerRead, tags=["Customer Auth"])
-async def update_customer_name(
+def update_customer_name(
     update_data: CustomerNameUpdate,
     current_customer: Customer = Depends(get_current_customer)
 ):
@@ -240,27 +438,42 @@ async def update_customer_name(
         session.add(customer_db)
         session.commit()
         session.refresh(customer_db)
+        invalidate_cached_user(customer_db.mail)
         return customer_db
 
+# Upload handlers are plain 'def' endpoints, so this copy already runs in the threadpool,
+# off the event loop. A 1 MiB buffer (vs shutil's 64 KiB default) cuts the read/write
+# syscalls per image.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Only these image types are stored; a name without an extension is saved as .jpg.
+# The suffix comes from pathlib, so "a.php.png" gives ".png" and "noext" gives "".
+ALLOWED_IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png", ".webp"})
+
+def image_extension(upload: UploadFile) -> str:
+    ext = PurePosixPath(upload.filename or "").suffix.lower() or ".jpg"
+    if ext not in ALLOWED_IMAGE_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported image type '{ext}'. Allowed: jpg, jpeg, png, webp")
+    return ext
+
+def save_upload(upload: UploadFile, file_path: str):
+    upload.file.seek(0)
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(upload.file, buffer, UPLOAD_CHUNK_SIZE)
+
 @app.post("/customer/me/upload-pfp", tags=["Customer Auth"])
-async def upload_profile_picture(
+def upload_profile_picture(
     file: UploadFile = File(...),
     current_customer: Customer = Depends(get_current_customer)
 ):
-    # 1. Define the location (Matches your Static Mount logic)
-    # base_dir/../data/profile_pictures
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    upload_dir = os.path.join(base_dir, "../data/profile_pictures")
-    os.makedirs(upload_dir, exist_ok=True)
+    # 1. Location: profile_uploads_dir (base_dir/../data/profile_pictures, created once at import)
     
     # 2. Generate unique filename
-    file_extension = file.filename.split(".")[-1]
-    new_filename = f"{current_customer.id}_{uuid.uuid4()}.{file_extension}"
-    file_path = os.path.join(upload_dir, new_filename)
+    new_filename = f"{current_customer.id}_{uuid.uuid4().hex}{image_extension(file)}"
+    file_path = os.path.join(profile_uploads_dir, new_filename)
     
     # 3. Save file to disk
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    save_upload(file, file_path)
         
     # 4. Update DB with the relative URL
     # The static mount is at /profile_pictures, so the URL is "profile_pictures/filename"
@@ -274,30 +487,45 @@ async def upload_profile_picture(
         
         session.add(customer_db)
         session.commit()
+
+    invalidate_cached_user(current_customer.mail)
         
     return {"image_url": relative_url}
 
+# Built once at import; validates a whole list of cart rows in one call
+_cart_items_adapter = TypeAdapter(List[CartItemReadWithProduct])
+
 # --- UPDATED ENDPOINT: Get Cart (Auto-creates if missing) ---
 @app.get("/cart", response_model=CartRead, tags=["Cart & Checkout"])
 async def get_customer_cart(
     customer: Customer = Depends(get_current_customer)
 ):
-    # Try to find existing cart
-    cart = await run_in_threadpool(get_cart_by_customer_id, customer_id=customer.id)
-    
     # FIX: If cart doesn't exist, create it now instead of returning 404
-    if not cart:
-        cart = await run_in_threadpool(create_cart_for_customer, customer_id=customer.id)
-        
-    detailed_items = await run_in_threadpool(get_detailed_cart_items, cart_id=cart.id)
-    
-    # Calculate total size safely
-    total_size = sum(item['quantity'] for item in detailed_items)
+    # Cart, items and total size come from one session in a single threadpool call
+    detailed_items, total_size = await run_in_threadpool(get_cart_with_items, customer_id=customer.id)
     
-    return {"items": detailed_items, "total_size": total_size}
+    # Validated once by the adapter, then sent as-is instead of re-validating through response_model
+    items = _cart_items_adapter.validate_python(detailed_items)
+    return ORJSONResponse(content={"items": _cart_items_adapter.dump_python(items), "total_size": total_size})
 
 
 
+# Same items as /cart, written one JSON object per line.
+# Doesn't include total_size; clients that need it should keep using /cart.
+@app.get("/cart/stream", tags=["Cart & Checkout"])
+async def stream_customer_cart(
+    customer: Customer = Depends(get_current_customer)
+):
+    # Rows are read up front and the session closed, so a slow client never holds a pooled connection
+    detailed_items, _ = await run_in_threadpool(get_cart_with_items, customer_id=customer.id)
+
+    async def ndjson_lines():
+        for item in detailed_items:
+            yield orjson.dumps(CartItemReadWithProduct.model_validate(item).model_dump()) + b"\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
 # Cart items of the customer
 # In main.py
 
@@ -308,16 +536,12 @@ async def get_customer_cart(
 @app.get("/customer/orders", response_model=List[OrderRecordsRead], tags=["Cart & Checkout"])
 def get_my_orders(customer: Customer = Depends(get_current_customer)):
     with Session(engine) as session:
-        orders_db = session.exec(select(OrderRecords).where(OrderRecords.customer_id == customer.id).order_by(OrderRecords.order_date.desc())).all()
+        orders_db = session.exec(STMT_ORDERS_BY_CUSTOMER, params={"cid": customer.id}).all()
         
         final_results = []
         for order in orders_db:
-            order_schema = OrderRecordsRead.model_validate(order)
-            items_with_product = session.exec(
-                select(OrderItem, Product.name)
-                .join(Product, Product.id == OrderItem.product_id)
-                .where(OrderItem.orderrecords_id == order.id)
-            ).all()
+            order_data = order.model_dump()
+            items_with_product = session.exec(STMT_ORDER_ITEMS_WITH_NAME, params={"oid": order.id}).all()
             
             order_items_data = []
             for item, p_name in items_with_product:
@@ -325,10 +549,11 @@ def get_my_orders(customer: Customer = Depends(get_current_customer)):
                 i_dict['product_name'] = p_name
                 order_items_data.append(i_dict)
             
-            order_schema.items = order_items_data
-            final_results.append(order_schema)
+            order_data['items'] = order_items_data
+            final_results.append(order_data)
             
-        return final_results
+        # Rows come straight from the DB, so skip re-validating them through response_model
+        return ORJSONResponse(content=final_results)
     
 # -------------------------------------------------------------------------------------------------------------------------------------------------
 # --- Retailer Auth Endpoints ---
@@ -340,12 +565,10 @@ async def signup_retailer(
     background_tasks: BackgroundTasks # <--- NEW: Required for sending email
 ):
     
-    exists = await run_in_threadpool(get_retailer_by_email, retailer.mail)
-    if exists:
-        raise HTTPException(status_code=400, detail="Email Already Registered")
-
     hashed_password = hash_password(retailer.password)
     
+    # The OTP is stored in the same transaction as the new account
+    otp = generate_otp()
     new_retailer = await run_in_threadpool(
         add_retailer,
         name=retailer.name,
@@ -359,27 +582,32 @@ async def signup_retailer(
         phone_number=retailer.phone_number,
         tax_id=retailer.tax_id,
         lat=retailer.lat,
-        lon=retailer.lon
+        lon=retailer.lon,
+        verification_otp=otp
     )
 
+    # add_retailer skips the insert when the email already exists
     if not new_retailer:
-        raise HTTPException(status_code=500, detail="Failed to create Retailer.")
+        raise HTTPException(status_code=400, detail="Email Already Registered")
     
     # --- NEW: Send Verification OTP ---
-    otp = generate_otp()
-    await run_in_threadpool(save_verification_otp, retailer.mail, otp)
     await send_verification_email(retailer.mail, otp, background_tasks)
     # ----------------------------------
     
-    return new_retailer
+    return trusted_response(RetailerRead, new_retailer, status.HTTP_201_CREATED)
 
 @app.post("/login/retailer", response_model=Token, tags=["Retailer Auth"])
+@limiter.limit(LOGIN_RATE_LIMIT)
 async def login_retailer(
+    request: Request,
     req: LoginRequest
 ):
     
     retailer = await run_in_threadpool(get_retailer_by_email, req.mail)
-    if not retailer:
+
+    # Same work and same error whether the mail or the password is wrong
+    password_ok = verify_password(req.password, retailer.hashed_password if retailer else DUMMY_PASSWORD_HASH)
+    if not retailer or not password_ok:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Credentials")
 
     # --- NEW: Verify if account is active ---
@@ -387,10 +615,10 @@ async def login_retailer(
         raise HTTPException(status_code=403, detail="Account not verified. Please verify your email.")
     # ----------------------------------------
 
-    if not verify_password(req.password, retailer.hashed_password):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Credentials")
-
     # Create and return JWT token
+    # Fresh login always reloads the user row on the next authenticated call
+    invalidate_cached_user(retailer.mail)
+
     access_token = create_access_token(data={"sub": retailer.mail, "role": "retailer"})
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -410,12 +638,10 @@ async def signup_wholesaler(
     background_tasks: BackgroundTasks # <--- NEW: Required for sending email
 ):
     
-    exists = await run_in_threadpool(get_wholesaler_by_email, wholesaler.mail)
-    if exists:
-        raise HTTPException(status_code=400, detail="Email Already Registered")
-
     hashed_password = hash_password(wholesaler.password)
     
+    # The OTP is stored in the same transaction as the new account
+    otp = generate_otp()
     new_wholesaler = await run_in_threadpool(
         add_wholesaler,
         name=wholesaler.name,
@@ -429,27 +655,32 @@ async def signup_wholesaler(
         phone_number=wholesaler.phone_number,
         tax_id=wholesaler.tax_id,
         lat=wholesaler.lat,
-        lon=wholesaler.lon
+        lon=wholesaler.lon,
+        verification_otp=otp
     )
 
+    # add_wholesaler skips the insert when the email already exists
     if not new_wholesaler:
-        raise HTTPException(status_code=500, detail="Failed to create Wholesaler.")
+        raise HTTPException(status_code=400, detail="Email Already Registered")
     
     # --- NEW: Send Verification OTP ---
-    otp = generate_otp()
-    await run_in_threadpool(save_verification_otp, wholesaler.mail, otp)
     await send_verification_email(wholesaler.mail, otp, background_tasks)
     # ----------------------------------
     
-    return new_wholesaler
+    return trusted_response(WholesalerRead, new_wholesaler, status.HTTP_201_CREATED)
 
 @app.post("/login/wholesaler", response_model=Token, tags=["Wholesaler Auth"])
+@limiter.limit(LOGIN_RATE_LIMIT)
 async def login_wholesaler(
+    request: Request,
     req: LoginRequest
 ):
     
     wholesaler = await run_in_threadpool(get_wholesaler_by_email, req.mail)
-    if not wholesaler:
+
+    # Same work and same error whether the mail or the password is wrong
+    password_ok = verify_password(req.password, wholesaler.hashed_password if wholesaler else DUMMY_PASSWORD_HASH)
+    if not wholesaler or not password_ok:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Credentials")
 
     # --- NEW: Verify if account is active ---
@@ -457,10 +688,10 @@ async def login_wholesaler(
         raise HTTPException(status_code=403, detail="Account not verified. Please verify your email.")
     # ----------------------------------------
 
-    if not verify_password(req.password, wholesaler.hashed_password):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Credentials")
-
     # Create and return JWT token
+    # Fresh login always reloads the user row on the next authenticated call
+    invalidate_cached_user(wholesaler.mail)
+
     access_token = create_access_token(data={"sub": wholesaler.mail, "role": "wholesaler"})
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -475,101 +706,88 @@ async def get_me(wholesaler: Wholesaler = Depends(get_current_wholesaler)):
 # --- IN main.py ---
 
 @app.post("/wholesaler/products/add", response_model=WholesalerProduct, tags=["Wholesaler Workflow"])
-async def add_wholesale_product(
+def add_wholesale_product(
     name: str = Form(...),
     price: float = Form(...),
     stock: int = Form(...),
     min_qty: int = Form(10),
     image: UploadFile = File(None), # <--- Image Upload
-    current_wholesaler: Wholesaler = Depends(get_current_wholesaler)
+    current_wholesaler: Wholesaler = Depends(get_current_wholesaler),
+    session: Session = Depends(get_session)
 ):
+    # Reject a bad image before anything is written
+    file_ext = image_extension(image) if image else None
+
     # 1. Create DB Object
-    with Session(engine) as session:
-        new_item = WholesalerProduct(
-            wholesaler_id=current_wholesaler.id,
-            name=name,
-            price=price,
-            stock=stock,
-            min_qty=min_qty,
-            image_url="product_images/default.png" # Default
-        )
-        session.add(new_item)
-        session.commit()
-        session.refresh(new_item)
-
-        # 2. Handle Image File
-        if image:
-            try:
-                file_ext = image.filename.split(".")[-1]
-                # Unique Name: ws_{id}_{uuid}.ext
-                file_name = f"ws_{new_item.id}_{uuid.uuid4()}.{file_ext}"
-                file_path = os.path.join(product_images_dir, file_name)
-                
-                with open(file_path, "wb") as buffer:
-                    shutil.copyfileobj(image.file, buffer)
-                
-                # Update URL in DB
-                new_item.image_url = f"product_images/{file_name}"
-                session.add(new_item)
-                session.commit()
-                session.refresh(new_item)
-            except Exception as e:
-                print(f"Image upload failed: {e}")
+    new_item = WholesalerProduct(
+        wholesaler_id=current_wholesaler.id,
+        name=name,
+        price=price,
+        stock=stock,
+        min_qty=min_qty,
+        image_url="product_images/default.png" # Default
+    )
+    session.add(new_item)
+    session.commit()
+    session.refresh(new_item)
 
-        return new_item
+    # 2. Handle Image File
+    if image:
+        try:
+            # Unique Name: ws_{id}_{uuid}.ext
+            file_name = f"ws_{new_item.id}_{uuid.uuid4().hex}{file_ext}"
+            file_path = os.path.join(product_images_dir, file_name)
+            
+            save_upload(image, file_path)
+            
+            # Update URL in DB
+            new_item.image_url = f"product_images/{file_name}"
+            session.add(new_item)
+            session.commit()
+            session.refresh(new_item)
+        except Exception:
+            logger.exception("Wholesale product image upload failed")
+
+    return new_item
 
 @app.get("/wholesaler/my-products", response_model=List[WholesalerProduct], tags=["Wholesaler Workflow"])
-def get_my_wholesale_inventory(current_wholesaler: Wholesaler = Depends(get_current_wholesaler)):
-    with Session(engine) as session:
-        statement = select(WholesalerProduct).where(WholesalerProduct.wholesaler_id == current_wholesaler.id)
-        return session.exec(statement).all()
+def get_my_wholesale_inventory(current_wholesaler: Wholesaler = Depends(get_current_wholesaler), session: Session = Depends(get_session)):
+    return session.exec(STMT_WHOLESALE_INVENTORY_BY_WID, params={"wid": current_wholesaler.id}).all()
 
 @app.put("/wholesaler/products/{item_id}", response_model=WholesalerProduct, tags=["Wholesaler Workflow"])
 def update_wholesale_product(
     item_id: int,
     update_data: WholesalerProductUpdate,
-    current_wholesaler: Wholesaler = Depends(get_current_wholesaler)
+    current_wholesaler: Wholesaler = Depends(get_current_wholesaler),
+    session: Session = Depends(get_session)
 ):
-    with Session(engine) as session:
-        item = session.get(WholesalerProduct, item_id)
-        if not item or item.wholesaler_id != current_wholesaler.id:
-            raise HTTPException(status_code=404, detail="Item not found")
-        
-        if update_data.price is not None: item.price = update_data.price
-        if update_data.stock is not None: item.stock = update_data.stock
-        if update_data.min_qty is not None: item.min_qty = update_data.min_qty
-        
-        session.add(item)
-        session.commit()
-        session.refresh(item)
-        return item
+    item = session.get(WholesalerProduct, item_id)
+    if not item or item.wholesaler_id != current_wholesaler.id:
+        raise HTTPException(status_code=404, detail="Item not found")
+    
+    if update_data.price is not None: item.price = update_data.price
+    if update_data.stock is not None: item.stock = update_data.stock
+    if update_data.min_qty is not None: item.min_qty = update_data.min_qty
     
+    session.add(item)
+    session.commit()
+    session.refresh(item)
+    return item
+
 
 
 @app.get("/wholesaler/orders", response_model=List[WholesaleOrderRead], tags=["Wholesaler Workflow"])
-def get_wholesale_orders(current_wholesaler: Wholesaler = Depends(get_current_wholesaler)):
-    with Session(engine) as session:
-        # Fetch pending/processing orders
-        statement = select(WholesaleOrder).where(
-            (WholesaleOrder.wholesaler_id == current_wholesaler.id) &
-            (WholesaleOrder.status.in_(["Pending", "Processing"]))
-        ).order_by(WholesaleOrder.order_date.desc())
-        
-        orders = session.exec(statement).all()
-        return _build_order_response(session, orders)
+def get_wholesale_orders(current_wholesaler: Wholesaler = Depends(get_current_wholesaler), session: Session = Depends(get_session)):
+    # Fetch pending/processing orders
+    orders = session.exec(STMT_WHOLESALE_ORDERS_BY_WID, params={"wid": current_wholesaler.id}).all()
+    return ORJSONResponse(content=_build_order_response(session, orders))
 
 
 @app.get("/wholesaler/history", response_model=List[WholesaleOrderRead], tags=["Wholesaler Workflow"])
-def get_wholesale_history(current_wholesaler: Wholesaler = Depends(get_current_wholesaler)):
-    with Session(engine) as session:
-        # Fetch completed orders
-        statement = select(WholesaleOrder).where(
-            (WholesaleOrder.wholesaler_id == current_wholesaler.id) &
-            (WholesaleOrder.status.in_(["Shipped", "Delivered", "Approved"]))
-        ).order_by(WholesaleOrder.order_date.desc())
-        
-        orders = session.exec(statement).all()
-        return _build_order_response(session, orders)
+def get_wholesale_history(current_wholesaler: Wholesaler = Depends(get_current_wholesaler), session: Session = Depends(get_session)):
+    # Fetch completed orders
+    orders = session.exec(STMT_WHOLESALE_HISTORY_BY_WID, params={"wid": current_wholesaler.id}).all()
+    return ORJSONResponse(content=_build_order_response(session, orders))
 
 # --- HELPER FUNCTION TO POPULATE DETAILS ---
 def _build_order_response(session, orders):
@@ -628,15 +846,16 @@ async def verify_account_endpoint(req: AccountVerificationRequest):
     success = await run_in_threadpool(verify_user_account, email, otp)
     if not success:
         raise HTTPException(status_code=400, detail="Invalid or Expired OTP")
+    invalidate_cached_user(email) # is_verified changed
 
     # 3. Determine Final Role
     final_role = role
     
-    # Fallback: If frontend didn't send role, check DB
+    # Fallback: If frontend didn't send role, check DB (one query across all three roles)
     if not final_role:
-        if await run_in_threadpool(get_customer_by_email, email): final_role = "customer"
-        elif await run_in_threadpool(get_retailer_by_email, email): final_role = "retailer"
-        elif await run_in_threadpool(get_wholesaler_by_email, email): final_role = "wholesaler"
+        account = await run_in_threadpool(find_account_by_email, email)
+        if account:
+            final_role = account.role
 
     if not final_role:
         raise HTTPException(status_code=404, detail="User verified but role not found.")
@@ -654,12 +873,8 @@ async def verify_account_endpoint(req: AccountVerificationRequest):
 
 @app.post("/auth/resend-verification", tags=["Auth"])
 async def resend_verification(email: str, background_tasks: BackgroundTasks):
-    # Check if user exists
-    customer = await run_in_threadpool(get_customer_by_email, email)
-    retailer = await run_in_threadpool(get_retailer_by_email, email)
-    wholesaler = await run_in_threadpool(get_wholesaler_by_email, email)
-    
-    user = customer or retailer or wholesaler
+    # Check if user exists (one query across all three roles)
+    user = await run_in_threadpool(find_account_by_email, email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -685,16 +900,31 @@ async def login_google(request: Request):
     redirect_uri = request.url_for('auth_google')
     return await oauth.google.authorize_redirect(request, redirect_uri)
 
+# Returning Google users: email -> (role, redirect page), filled once their account is
+# found/created and verified, so repeat sign-ins skip the role lookups entirely.
+GOOGLE_ROLE_CACHE_TTL_SECONDS = 600
+_google_role_cache = TTLCache(maxsize=10_000, ttl=GOOGLE_ROLE_CACHE_TTL_SECONDS)
+_google_role_cache_lock = threading.Lock()
+
 # FIND AND REPLACE THE ENTIRE 'auth_google' FUNCTION WITH THIS:
 
 @app.get("/auth/google", tags=["Social Auth"])
 async def auth_google(request: Request):
     try:
         token = await oauth.google.authorize_access_token(request)
-        user_info = token.get('userinfo') or await oauth.google.userinfo(token=token)
+        # The 'openid' scope makes Google return an id_token, which authlib parses into
+        # 'userinfo' here, so no second call to the userinfo endpoint is needed
+        user_info = token['userinfo']
         email = user_info.get('email')
         name = user_info.get('name') or email.split('@')[0] 
 
+        with _google_role_cache_lock:
+            cached = _google_role_cache.get(email)
+        if cached is not None:
+            role, redirect_page = cached
+            access_token = create_access_token(data={"sub": email, "role": role})
+            return RedirectResponse(url=f"/{redirect_page}?token={access_token}")
+
         role = "customer"
         redirect_page = "Customer.html"
         
@@ -704,10 +934,8 @@ async def auth_google(request: Request):
             role = "retailer"
             redirect_page = "Retailer.html"
             if not retailer.is_verified:
-                with Session(engine) as s:
-                    r = s.get(Retailer, retailer.id)
-                    r.is_verified = True
-                    s.add(r); s.commit()
+                await run_in_threadpool(mark_user_verified, Retailer, retailer.id)
+                invalidate_cached_user(email)
         
         # Check Wholesaler
         elif await run_in_threadpool(get_wholesaler_by_email, email):
@@ -717,56 +945,138 @@ async def auth_google(request: Request):
         # Default to Customer
         else:
             customer = await run_in_threadpool(get_customer_by_email, mail=email)
-            if not customer:
-                random_pass = hash_password(email + datetime.utcnow().isoformat())
-                customer = await run_in_threadpool(add_customer, name=name, mail=email, hashed_password=random_pass)
-            
-            if not customer.is_verified:
-                 with Session(engine) as s:
-                    c = s.get(Customer, customer.id)
-                    c.is_verified = True
-                    s.add(c); s.commit()
+            # New or unverified: one upsert creates/verifies it (also safe against a concurrent signup)
+            if not customer or not customer.is_verified:
+                await run_in_threadpool(
+                    upsert_verified_customer, name=name, mail=email, hashed_password=make_unverifiable_password()
+                )
+                invalidate_cached_user(email)
         
+        with _google_role_cache_lock:
+            _google_role_cache[email] = (role, redirect_page)
         access_token = create_access_token(data={"sub": email, "role": role})
         return RedirectResponse(url=f"/{redirect_page}?token={access_token}")
              
     except Exception as e:
-        print(f"GOOGLE AUTH ERROR: {str(e)}")
+        logger.exception("Google auth failed")
         raise HTTPException(status_code=400, detail=f"Google Login Failed: {str(e)}")
     
 # -------------------------------------------------------------------------------------------------------------------------------------------------
 # --- Product Endpoints ---
 # -------------------------------------------------------------------------------------------------------------------------------------------------
 
+# Serialized product detail bodies + ETags, keyed by product_id, and serialized
+# /products listings keyed by their filters.
+# Anything that writes a Product row calls invalidate_cached_products(), but these caches
+# live in this process only: with several uvicorn workers the others keep serving their
+# copy until it expires, so both TTLs are kept short enough that stock/price lag by seconds.
+PRODUCT_CACHE_TTL_SECONDS = 5
+PRODUCT_LIST_CACHE_TTL_SECONDS = 5
+_product_cache = TTLCache(maxsize=50_000, ttl=PRODUCT_CACHE_TTL_SECONDS)
+_product_list_cache = TTLCache(maxsize=1_024, ttl=PRODUCT_LIST_CACHE_TTL_SECONDS)
+_product_cache_lock = threading.Lock()
+_product_list_adapter = TypeAdapter(List[ProductRead])
+
+# Bumped by every invalidation. A read that started before a write must not store
+# the body it built from the old row, so it only caches if the generation is unchanged.
+_product_cache_generation = 0
+
+# Browsers may reuse a listing for as long as the server would serve it from cache anyway.
+# Detail bodies always revalidate (cheap 304s when the ETag still matches).
+# After that, a stale listing may still be shown for a few seconds while it revalidates.
+PRODUCT_LIST_CACHE_CONTROL = f"public, max-age={PRODUCT_LIST_CACHE_TTL_SECONDS}, stale-while-revalidate={PRODUCT_LIST_CACHE_TTL_SECONDS}"
+PRODUCT_DETAIL_CACHE_CONTROL = "no-cache"
+
+# 64-bit BLAKE2b: plenty to tell product bodies apart, and cheaper than md5
+def product_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+# If-None-Match may list several tags, and proxies that re-compress send them back weak (W/"...")
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+# 304 when the client already holds this exact body, otherwise the cached bytes.
+# Brotli only adds "Vary: Accept-Encoding" to bodies it compresses, so set it on the rest.
+def conditional_json_response(request: Request, body: bytes, etag: str, headers: dict) -> Response:
+    headers = {**headers, "ETag": etag}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={**headers, "Vary": "Accept-Encoding"})
+    if len(body) < COMPRESS_MINIMUM_SIZE:
+        headers["Vary"] = "Accept-Encoding"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def invalidate_cached_products(*product_ids: int):
+    global _product_cache_generation
+    with _product_cache_lock:
+        _product_cache_generation += 1
+        # Any product change can move it in or out of a listing
+        _product_list_cache.clear()
+        if not product_ids:
+            _product_cache.clear()
+        for product_id in product_ids:
+            _product_cache.pop(product_id, None)
+
 # 1. GET ALL PRODUCTS
 # Matches requests to "/products" (e.g., from dashboard.html)
 @app.get("/products", response_model=List[ProductRead], tags=["Products"])
 def get_all_products(
+    request: Request,
     q: Optional[str] = None,
     category: Optional[str] = None, 
     min_price: Optional[float] = None, 
     max_price: Optional[float] = None,
-    sort_by: Optional[str] = "newest"
+    sort_by: Optional[str] = "newest",
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[int] = None
 ):
+    key = (q, category, min_price, max_price, sort_by, limit, cursor)
+    with _product_cache_lock:
+        cached = _product_list_cache.get(key)
+        generation = _product_cache_generation
+
+    if cached is None:
+        products = _query_products(q, category, min_price, max_price, sort_by, limit, cursor)
+        body = orjson.dumps(_product_list_adapter.dump_python(_product_list_adapter.validate_python(products)))
+        cached = (body, product_etag(body), next_page_cursor(products, limit))
+        with _product_cache_lock:
+            if generation == _product_cache_generation:
+                _product_list_cache[key] = cached
+
+    body, etag, next_cursor = cached
+    headers = {"Cache-Control": PRODUCT_LIST_CACHE_CONTROL, **(page_headers(next_cursor) or {})}
+    return conditional_json_response(request, body, etag, headers)
+
+# --- FIX: HARDCODED CATEGORY MAPPING ---
+# Matches the IDs used in retailer-add-product.html
+PRODUCT_CATEGORY_IDS = {
+    "electronics": 1,
+    "groceries": 2,
+    "fashion": 3,
+    "books": 5,
+    "sports": 8, # Matches 'Sports' in your HTML
+    "home": 7    # Matches 'Home' in your HTML
+    # Add others if needed
+}
+
+# Built as a lambda_stmt: each "+= lambda" step is cached by its code location, and the
+# values it closes over (search term, ids, prices, cursor) become bound parameters.
+# So every filter combination compiles to SQL once and is reused for any values.
+def _query_products(q, category, min_price, max_price, sort_by, limit=None, cursor=None):
     with Session(engine) as session:
-        query = select(Product)
-        
-        # --- FIX: HARDCODED CATEGORY MAPPING ---
-        # Matches the IDs used in retailer-add-product.html
-        cat_map = {
-            "electronics": 1,
-            "groceries": 2,
-            "fashion": 3,
-            "books": 5,
-            "sports": 8, # Matches 'Sports' in your HTML
-            "home": 7    # Matches 'Home' in your HTML
-            # Add others if needed
-        }
+        query = lambda_stmt(lambda: select(Product))
+        params = {}
 
         # Search Logic
-        if q:
+        if q and len(q) >= PRODUCT_FTS_MIN_TERM:
+            query += lambda s: s.where(Product.id.in_(STMT_PRODUCT_IDS_MATCHING))
+            params["term"] = product_search_term(q)
+        elif q:
             search_term = f"%{q}%"
-            query = query.where(
+            query += lambda s: s.where(
                 or_(
                     col(Product.name).ilike(search_term),
                     col(Product.description).ilike(search_term)
@@ -775,42 +1085,64 @@ def get_all_products(
             
         # Category Logic
         if category and category.lower() != "all":
-            if category.isdigit():
-                query = query.where(Product.category_id == int(category))
-            else:
-                # Check our manual map instead of the empty DB table
-                cat_id = cat_map.get(category.lower())
-                if cat_id:
-                    query = query.where(Product.category_id == cat_id)
+            # Check our manual map instead of the empty DB table
+            cat_id = int(category) if category.isdigit() else PRODUCT_CATEGORY_IDS.get(category.lower())
+            if cat_id:
+                query += lambda s: s.where(Product.category_id == cat_id)
             
         # Filtering & Sorting
         if min_price is not None:
-            query = query.where(Product.price >= min_price)
+            query += lambda s: s.where(Product.price >= min_price)
         if max_price is not None:
-            query = query.where(Product.price <= max_price)
+            query += lambda s: s.where(Product.price <= max_price)
             
+        # id breaks price ties, so (price, id) is a stable keyset for the cursor
         if sort_by == "price_low":
-            query = query.order_by(Product.price.asc())
+            if cursor is not None:
+                query += lambda s: s.where(tuple_(Product.price, Product.id) > tuple_(
+                    select(Product.price).where(Product.id == cursor).scalar_subquery(), cursor
+                ))
+            query += lambda s: s.order_by(Product.price.asc(), Product.id.asc())
         elif sort_by == "price_high":
-            query = query.order_by(Product.price.desc())
+            if cursor is not None:
+                query += lambda s: s.where(tuple_(Product.price, Product.id) < tuple_(
+                    select(Product.price).where(Product.id == cursor).scalar_subquery(), cursor
+                ))
+            query += lambda s: s.order_by(Product.price.desc(), Product.id.desc())
         else:
-            query = query.order_by(Product.id.desc())
-            
-        return session.exec(query).all()
+            if cursor is not None:
+                query += lambda s: s.where(Product.id < cursor)
+            query += lambda s: s.order_by(Product.id.desc())
+
+        if limit is not None:
+            query += lambda s: s.limit(limit)
+
+        return session.scalars(query, params).all()
 
 # 2. GET SINGLE PRODUCT
 # Matches requests to "/products/100" (e.g., from product-details.html)
 @app.get("/products/{product_id}", response_model=ProductRead, tags=["Products"])
-async def get_product_detail(product_id: int):
-    with Session(engine) as session:
+def get_product_detail(product_id: int, request: Request, session: Session = Depends(get_session)):
+    with _product_cache_lock:
+        cached = _product_cache.get(product_id)
+        generation = _product_cache_generation
+
+    if cached is None:
         product = session.get(Product, product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
-        return product
+        body = orjson.dumps(ProductRead.model_validate(product).model_dump())
+        cached = (body, product_etag(body))
+        with _product_cache_lock:
+            if generation == _product_cache_generation:
+                _product_cache[product_id] = cached
+
+    body, etag = cached
+    return conditional_json_response(request, body, etag, {"Cache-Control": PRODUCT_DETAIL_CACHE_CONTROL})
 
 # 3. ADD PRODUCT
 @app.post("/products/add/", response_model=ProductRead, status_code=status.HTTP_201_CREATED, tags=["Products"])
-async def create_product_endpoint(
+def create_product_endpoint(
     name: str = Form(...),
     price: float = Form(...),
     stock: int = Form(...),
@@ -819,10 +1151,12 @@ async def create_product_endpoint(
     image: UploadFile = File(None), # Optional file upload
     current_retailer: Retailer = Depends(get_current_retailer)
 ):
+    # Reject a bad image before the product is created
+    file_extension = image_extension(image) if image else None
+
     # 1. Create the product in DB first (to get the ID)
     # We set a temporary image_url
-    new_product = await run_in_threadpool(
-        add_product,
+    new_product = add_product(
         name, price, stock, current_retailer.id,
         description, category_id, "" 
     )
@@ -834,20 +1168,17 @@ async def create_product_endpoint(
     if image:
         # Create file path: product_images/{id}.jpg
         # We preserve the original extension or default to .jpg
-        file_extension = image.filename.split(".")[-1]
-        file_name = f"{new_product.id}.{file_extension}"
+        file_name = f"{new_product.id}{file_extension}"
         file_path = os.path.join(product_images_dir, file_name)
         
         try:
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(image.file, buffer)
+            save_upload(image, file_path)
             
             # Update DB with the new path
             # Note: We use forward slashes for URL compatibility
             relative_path = f"product_images/{file_name}"
             
-            # We need a small helper to update just the image_url
-            # For now, we can re-use update_product_details or do it manually here
+            # Only image_url changes, so set it directly on the new row
             with Session(engine) as session:
                 p = session.get(Product, new_product.id)
                 p.image_url = relative_path
@@ -856,8 +1187,8 @@ async def create_product_endpoint(
                 session.refresh(p)
                 new_product = p # Update return object
                 
-        except Exception as e:
-            print(f"Error saving image: {e}")
+        except Exception:
+            logger.exception("Error saving product image")
             # We don't fail the request, just the image upload part
             pass
     else:
@@ -870,54 +1201,34 @@ async def create_product_endpoint(
             session.refresh(p)
             new_product = p
 
-    return new_product
+    invalidate_cached_products(new_product.id)
+    return trusted_response(ProductRead, new_product, status.HTTP_201_CREATED)
 
 
 # 1. DELETE PRODUCT
 @app.delete("/retailer/products/{product_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Retailer Workflow"])
-async def delete_product(
+def delete_product(
     product_id: int,
-    current_retailer: Retailer = Depends(get_current_retailer)
+    current_retailer: Retailer = Depends(get_current_retailer),
+    session: Session = Depends(get_session)
 ):
-    with Session(engine) as session:
-        product = session.get(Product, product_id)
-        if not product:
-            raise HTTPException(status_code=404, detail="Product not found")
-        if product.retailer_id != current_retailer.id:
-            raise HTTPException(status_code=403, detail="Not authorized to delete this product")
-        
-        session.delete(product)
-        session.commit()
-        return None
+    product = session.get(Product, product_id)
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    if product.retailer_id != current_retailer.id:
+        raise HTTPException(status_code=403, detail="Not authorized to delete this product")
+    
+    session.delete(product)
+    session.commit()
+    invalidate_cached_products(product_id)
+    return None
 
 # 2. GET CUSTOMER PURCHASE HISTORY (For this retailer)
 @app.get("/retailer/customer-history", tags=["Retailer Workflow"])
-async def get_customer_history(current_retailer: Retailer = Depends(get_current_retailer)):
+def get_customer_history(current_retailer: Retailer = Depends(get_current_retailer)):
     with Session(engine) as session:
-        # Get all orders containing this retailer's products
-        # We join OrderItem -> Product -> OrderRecords -> Customer
-        statement = select(OrderRecords, Customer, Product, OrderItem)\
-            .join(OrderItem, OrderItem.orderrecords_id == OrderRecords.id)\
-            .join(Product, Product.id == OrderItem.product_id)\
-            .join(Customer, Customer.id == OrderRecords.customer_id)\
-            .where(Product.retailer_id == current_retailer.id)\
-            .order_by(OrderRecords.order_date.desc())
-            
-        results = session.exec(statement).all()
-        
-        # Format data for frontend
-        history = []
-        for order, customer, product, item in results:
-            history.append({
-                "order_id": order.id,
-                "date": order.order_date,
-                "customer_name": customer.name,
-                "customer_email": customer.mail,
-                "product_name": product.name,
-                "quantity": item.quantity,
-                "total_paid": item.price_at_purchase * item.quantity
-            })
-        return history
+        # Rows already carry the frontend's keys, so they map straight to dicts
+        return [row._asdict() for row in session.exec(STMT_CUSTOMER_HISTORY_BY_RETAILER, params={"rid": current_retailer.id})]
 
 # 3. B2B: GET WHOLESALE PRODUCTS (Mock logic: Wholesaler items are just products with a flag or separate table)
 # For simplicity, we'll return a mock list or query a specific "Wholesale" category if you have one.
@@ -965,30 +1276,37 @@ def place_wholesale_order(
             raise HTTPException(status_code=400, detail=f"Insufficient stock. Available: {ws_product.stock}")
 
         # 3. DEDUCT STOCK (The Fix)
-        ws_product.stock -= quantity
-        session.add(ws_product)
+        # Conditional UPDATE, so two retailers can't both take the last units
+        taken = session.exec(
+            update(WholesalerProduct)
+            .where(WholesalerProduct.id == item_id, WholesalerProduct.stock >= quantity)
+            .values(stock=WholesalerProduct.stock - quantity)
+        )
+        if taken.rowcount != 1:
+            session.rollback()
+            session.refresh(ws_product)
+            raise HTTPException(status_code=400, detail=f"Insufficient stock. Available: {ws_product.stock}")
 
-        # 4. Create Order Record
+        # 4. Create Order Record (RETURNING gives the id without a commit + refresh)
         total_cost = ws_product.price * quantity
-        new_order = WholesaleOrder(
-            retailer_id=current_retailer.id,
-            wholesaler_id=ws_product.wholesaler_id,
-            status="Pending",
-            total_price=total_cost,
-            delivery_address=current_retailer.address
-        )
-        session.add(new_order)
-        session.commit()
-        session.refresh(new_order)
+        order_id = session.scalars(
+            insert(WholesaleOrder).values(
+                retailer_id=current_retailer.id,
+                wholesaler_id=ws_product.wholesaler_id,
+                order_date=datetime.utcnow(),
+                status="Pending",
+                total_price=total_cost,
+                delivery_address=current_retailer.address
+            ).returning(WholesaleOrder.id)
+        ).one()
         
-        # 5. Link Order Item
-        order_item = WholesaleOrderItem(
-            wholesale_order_id=new_order.id,
+        # 5. Link Order Item, then commit stock, order and item together
+        session.execute(insert(WholesaleOrderItem).values(
+            wholesale_order_id=order_id,
             product_id=ws_product.id, # Linking to WholesalerProduct ID
             quantity=quantity,
             price_per_unit=ws_product.price
-        )
-        session.add(order_item)
+        ))
         session.commit()
         
         return {"message": "Order placed successfully! Stock reserved."}
@@ -1005,16 +1323,13 @@ async def add_to_cart(
     customer: Customer = Depends(get_current_customer) # This endpoint is now secured
 ):
     
-    cart = await run_in_threadpool(get_cart_by_customer_id, customer_id=customer.id)
-    if not cart:
-        raise HTTPException(status_code=404, detail="Customer cart not found")
-    
     try:
+        # Cart lookup, stock check and write share one session
         new_item = await run_in_threadpool(
             add_item_to_cart,
             product_id=item.product_id,
             quantity=item.quantity,
-            cart_id=cart.id
+            customer_id=customer.id
         )
         return new_item
     except HTTPException as e:
@@ -1023,20 +1338,19 @@ async def add_to_cart(
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/cart", response_model=CartRead, tags=["Cart & Checkout"])
-async def get_customer_cart(
-    customer: Customer = Depends(get_current_customer) # This endpoint is now secured
+@app.post("/cart/bulk-add", response_model=List[ShoppingCartItemRead], tags=["Cart & Checkout"])
+async def bulk_add_to_cart(
+    items: List[ShoppingCartItemCreate],
+    customer: Customer = Depends(get_current_customer)
 ):
-    
-    cart = await run_in_threadpool(get_cart_by_customer_id, customer_id=customer.id)
-    if not cart:
-        raise HTTPException(status_code=404, detail="Customer cart not found")
-        
-    detailed_items = await run_in_threadpool(get_detailed_cart_items, cart_id=cart.id)
-    
-    total_size = sum(item['quantity'] for item in detailed_items)
-    
-    return {"items": detailed_items, "total_size": total_size}
+    # Several /cart/add calls in one request: one auth, one cart lookup, one transaction
+    cart = await run_in_threadpool(get_or_create_cart, customer_id=customer.id)
+
+    return await run_in_threadpool(
+        add_items_to_cart,
+        cart_id=cart.id,
+        items=[item.model_dump() for item in items]
+    )
 
 
 @app.post("/order/checkout", response_model=OrderRecordsRead, tags=["Cart & Checkout"])
@@ -1051,7 +1365,7 @@ async def checkout(
         
     try:
         # 2. Process Checkout (Database Transaction)
-        new_order = await run_in_threadpool(
+        new_order, items_db = await run_in_threadpool(
             process_checkout,
             customer=customer,
             order_details=order_details
@@ -1060,44 +1374,40 @@ async def checkout(
         if not new_order:
              raise HTTPException(status_code=400, detail="Checkout failed. Cart might be empty.")
 
+        # no_of_purchases changed, so drop the cached customer row
+        invalidate_cached_user(customer.mail)
+
         # 3. --- NEW: PREPARE EMAIL DATA ---
-        # We need to fetch the item names because 'process_checkout' consumes the cart
-        # and OrderRecords usually just has IDs.
-        with Session(engine) as session:
-            # Join OrderItem with Product to get the names
-            items_db = session.exec(
-                select(OrderItem, Product.name)
-                .join(Product, Product.id == OrderItem.product_id)
-                .where(OrderItem.orderrecords_id == new_order.id)
-            ).all()
-            
-            email_items = []
-            for item, p_name in items_db:
-                email_items.append({
-                    "name": p_name,
-                    "qty": item.quantity,
-                    "price": item.price_at_purchase
-                })
-            
-            full_address = f"{new_order.shipping_address}, {new_order.shipping_city}, {new_order.shipping_pincode}"
-            
-            # 4. Send Email in Background
-            await send_order_confirmation_email(
-                email=customer.mail,
-                name=customer.name,
-                order_id=new_order.id,
-                total_price=new_order.total_price,
-                items=email_items,
-                address=full_address,
-                background_tasks=background_tasks
-            )
+        # process_checkout hands back the purchased lines with their product names
+        invalidate_cached_products(*(item.product_id for item, _ in items_db))
+        
+        email_items = []
+        for item, p_name in items_db:
+            email_items.append({
+                "name": p_name,
+                "qty": item.quantity,
+                "price": item.price_at_purchase
+            })
+        
+        full_address = f"{new_order.shipping_address}, {new_order.shipping_city}, {new_order.shipping_pincode}"
+        
+        # 4. Send Email in Background
+        await send_order_confirmation_email(
+            email=customer.mail,
+            name=customer.name,
+            order_id=new_order.id,
+            total_price=new_order.total_price,
+            items=email_items,
+            address=full_address,
+            background_tasks=background_tasks
+        )
 
         return new_order
         
     except HTTPException as e:
         raise e 
     except Exception as e:
-        print(f"Checkout Error: {str(e)}")
+        logger.exception("Checkout failed")
         raise HTTPException(status_code=500, detail=f"An error occurred during checkout: {str(e)}")
 
 
@@ -1106,10 +1416,17 @@ async def checkout(
 # -------------------------------------------------------------------------------------------------------------------------------------------------
 
 @app.get("/retailer/my-products", response_model=List[ProductRead], tags=["Retailer Workflow"])
-async def get_my_products(current_retailer: Retailer = Depends(get_current_retailer)):
+async def get_my_products(
+    current_retailer: Retailer = Depends(get_current_retailer),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[int] = None
+):
     
-    products = await run_in_threadpool(get_products_by_retailer, retailer_id=current_retailer.id)
-    return products
+    products = await run_in_threadpool(get_products_by_retailer, retailer_id=current_retailer.id, limit=limit, cursor=cursor)
+    return ORJSONResponse(
+        content=[p.model_dump() for p in products],
+        headers=page_headers(next_page_cursor(products, limit))
+    )
 
 
 @app.get("/retailers/locations", tags=["Retailer Workflow"])
@@ -1117,19 +1434,13 @@ def get_retailer_locations():
     """Returns a list of retailers with their coordinates for the map."""
     with Session(engine) as session:
         # Fetch retailers who have lat/lon set
-        statement = select(Retailer).where(Retailer.lat != None).where(Retailer.lon != None)
-        retailers = session.exec(statement).all()
+        rows = session.exec(STMT_RETAILER_LOCATIONS).all()
         
-        map_data = []
-        for r in retailers:
-            map_data.append({
-                "id": r.id,
-                "name": r.business_name,
-                "lat": r.lat,
-                "lon": r.lon,
-                "address": r.address
-            })
-        return map_data
+        map_data = [
+            {"id": r_id, "name": name, "lat": lat, "lon": lon, "address": address}
+            for r_id, name, lat, lon, address in rows
+        ]
+        return ORJSONResponse(content=map_data)
 
 
 @app.put("/retailer/products/{product_id}", response_model=ProductRead, tags=["Retailer Workflow"])
@@ -1139,15 +1450,14 @@ async def update_product(
     current_retailer: Retailer = Depends(get_current_retailer)
 ):
     
-    product = await run_in_threadpool(get_product_by_id, product_id=product_id)
-    
-    # Check if product exists and belongs to the retailer
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    if product.retailer_id != current_retailer.id:
-        raise HTTPException(status_code=403, detail="Not authorized to update this product")
-        
-    updated_product = await run_in_threadpool(update_product_details, product=product, update_data=update_data)
+    # Raises 404 if the product is missing, 403 if it belongs to another retailer
+    updated_product = await run_in_threadpool(
+        update_retailer_product,
+        product_id=product_id,
+        retailer_id=current_retailer.id,
+        update_data=update_data
+    )
+    invalidate_cached_products(product_id)
     return updated_product
 
 @app.get("/retailer/orders", response_model=List[OrderRecordsRead], tags=["Retailer Workflow"])
@@ -1155,7 +1465,7 @@ async def get_my_orders(current_retailer: Retailer = Depends(get_current_retaile
     
     orders = await run_in_threadpool(get_orders_by_retailer, retailer_id=current_retailer.id)
     # Note: This returns orders without the 'items' list populated.
-    return orders
+    return ORJSONResponse(content=[{**o.model_dump(), "items": []} for o in orders])
 
 @app.put("/retailer/orders/{order_id}/status", response_model=OrderRecordsRead, tags=["Retailer Workflow"])
 async def update_order(
@@ -1164,37 +1474,27 @@ async def update_order(
     background_tasks: BackgroundTasks, # <--- CRITICAL: ADD THIS
     current_retailer: Retailer = Depends(get_current_retailer)
 ):
-    # 1. Verification (Original logic)
-    retailer_orders = await run_in_threadpool(get_orders_by_retailer, retailer_id=current_retailer.id)
-    order_ids = [order.id for order in retailer_orders]
-    
-    if order_id not in order_ids:
+    # 1. Verification and update in one threadpool hop: EXISTS-scoped lookup, then the UPDATE
+    result = await run_in_threadpool(
+        update_order_for_retailer,
+        order_id=order_id,
+        retailer_id=current_retailer.id,
+        status_update=status_update
+    )
+    if not result:
         raise HTTPException(status_code=403, detail="Not authorized to update this order")
-        
-    # 2. Get Order and Update DB
-    order = await run_in_threadpool(get_order_by_id, order_id=order_id)
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    new_status = status_update.status
-    old_status = order.status # Capture status before updating
-
-    updated_order = await run_in_threadpool(update_order_status, order=order, status_update=status_update)
-
-    # 3. --- NEW: SEND EMAIL NOTIFICATION (Only if status changed) ---
-    if new_status != old_status:
-        with Session(engine) as session:
-            # Fetch Customer details required for email
-            customer = session.get(Customer, updated_order.customer_id)
-            
-            if customer:
-                await send_status_update_email(
-                    email=customer.mail,
-                    name=customer.name,
-                    order_id=updated_order.id,
-                    new_status=new_status,
-                    background_tasks=background_tasks
-                )
+    updated_order, old_status, customer = result
+
+    # 2. --- NEW: SEND EMAIL NOTIFICATION (Only if status changed) ---
+    # The customer is only loaded when the status actually changed
+    if updated_order.status != old_status and customer:
+        await send_status_update_email(
+            email=customer.mail,
+            name=customer.name,
+            order_id=updated_order.id,
+            new_status=updated_order.status,
+            background_tasks=background_tasks
+        )
     # -------------------------------------------------------------------
     
     return updated_order
@@ -1204,54 +1504,22 @@ async def update_order(
 # --- Wholesaler Workflow ---
 
 @app.put("/wholesaler/orders/{order_id}/status", response_model=WholesaleOrder, tags=["Wholesaler Workflow"])
-def update_wholesale_order_status(
+async def update_wholesale_order_status(
     order_id: int,
     status_update: OrderStatusUpdate,
     current_wholesaler: Wholesaler = Depends(get_current_wholesaler)
 ):
-    with Session(engine) as session:
-        order = session.get(WholesaleOrder, order_id)
-        if not order: raise HTTPException(status_code=404, detail="Order not found")
-        if order.wholesaler_id != current_wholesaler.id: raise HTTPException(status_code=403, detail="Not authorized")
-            
-        # --- STATUS LOGIC ---
-        # If changing to "Shipped", add stock to Retailer
-        if status_update.status == "Shipped" and order.status != "Shipped":
-            items = session.exec(select(WholesaleOrderItem).where(WholesaleOrderItem.wholesale_order_id == order.id)).all()
-            
-            for item in items:
-                # Find product details from Wholesaler Inventory
-                ws_product = session.get(WholesalerProduct, item.product_id)
-                if not ws_product: continue
-
-                # Check if Retailer already has this product
-                retailer_product = session.exec(
-                    select(Product)
-                    .where(Product.retailer_id == order.retailer_id)
-                    .where(Product.name == ws_product.name)
-                ).first()
-
-                if retailer_product:
-                    retailer_product.stock += item.quantity
-                    session.add(retailer_product)
-                else:
-                    # Create new product for Retailer
-                    new_prod = Product(
-                        name=ws_product.name,
-                        price=ws_product.price * 1.2, # Default 20% markup
-                        stock=item.quantity,
-                        retailer_id=order.retailer_id,
-                        description="Sourced from Wholesaler",
-                        category_id=1, 
-                        image_url=ws_product.image_url
-                    )
-                    session.add(new_prod)
-
-        order.status = status_update.status
-        session.add(order)
-        session.commit()
-        session.refresh(order)
-        return order
+    # Status change + retailer restock run as one DB transaction in the threadpool
+    order = await run_in_threadpool(
+        apply_wholesale_order_status,
+        order_id=order_id,
+        wholesaler_id=current_wholesaler.id,
+        new_status=status_update.status
+    )
+    # Shipping restocks (or creates) retailer products we don't have ids for here
+    if status_update.status == "Shipped":
+        invalidate_cached_products()
+    return order
 
 # -------------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -1260,29 +1528,12 @@ def update_wholesale_order_status(
 async def forgot_password(request: ForgotPasswordRequest , background_tasks: BackgroundTasks):
 
     email = request.email
-
-    customer = await run_in_threadpool(get_customer_by_email, email)
-    retailer = await run_in_threadpool(get_retailer_by_email, email)
-    wholesaler = await run_in_threadpool(get_wholesaler_by_email, email)
-
-    if not (customer or retailer or wholesaler):
-        raise HTTPException(status_code=404 , detail="User with this mail does not exist")
-    
     otp = generate_otp()
-    expiration = datetime.utcnow() + timedelta(minutes=10) # OTP is valid for 10min
 
-    with Session(engine) as session:
-        
-        existing = session.exec(select(PasswordReset).where(PasswordReset.email == email)).all()
-
-        # Deleting the record if exists a already OTP request
-        for record in existing:
-            session.delete(record)
-
-        # Making a new one
-        reset_entry = PasswordReset(email=email, otp=otp, expires_at=expiration)
-        session.add(reset_entry)
-        session.commit()
+    # Checks all three roles and stores the OTP using a single session
+    user_exists = await run_in_threadpool(save_password_reset_otp, email, otp)
+    if not user_exists:
+        raise HTTPException(status_code=404 , detail="User with this mail does not exist")
 
     await send_otp_email(email , otp, background_tasks)
 
@@ -1294,76 +1545,48 @@ async def forgot_password(request: ForgotPasswordRequest , background_tasks: Bac
 def reset_password(request: ResetPasswordRequest): # Removed async
     with Session(engine) as session:
         # 1. Validate OTP
-        statement = select(PasswordReset).where(
-            (PasswordReset.email == request.email) &
-            (PasswordReset.otp == request.otp) 
-        )
-        reset_record = session.exec(statement).first()
+        reset_record = session.exec(STMT_RESET_BY_EMAIL_OTP, params={"email": request.email, "otp": request.otp}).first()
 
         if not reset_record:
             raise HTTPException(status_code=400, detail="Invalid OTP.")
         
+        # Expired rows are left for the periodic purge (purge_expired_otps), no write here
         if reset_record.expires_at < datetime.utcnow():
-            session.delete(reset_record)
-            session.commit()
             raise HTTPException(status_code=400, detail="OTP has expired.")
         
         # 2. Update Password (Hash it once)
         new_hashed_password = hash_password(request.new_password)
         
-        user_found = False
-
-        # Check Customer (Always check)
-        customer = session.exec(select(Customer).where(Customer.mail == request.email)).first()
-        if customer:
-            customer.hashed_password = new_hashed_password
-            session.add(customer)
-            user_found = True
-
-        # Check Retailer (Always check - REMOVED "if not user_found")
-        retailer = session.exec(select(Retailer).where(Retailer.mail == request.email)).first()
-        if retailer:
-            retailer.hashed_password = new_hashed_password
-            session.add(retailer)
-            user_found = True
-
-        # Check Wholesaler (Always check - REMOVED "if not user_found")
-        wholesaler = session.exec(select(Wholesaler).where(Wholesaler.mail == request.email)).first()
-        if wholesaler:
-            wholesaler.hashed_password = new_hashed_password
-            session.add(wholesaler)
-            user_found = True
+        # Update every role with this mail directly; no user rows are loaded
+        params = {"email": request.email, "hashed": new_hashed_password}
+        updated = sum(session.exec(stmt, params=params).rowcount for stmt in STMTS_SET_PASSWORD_BY_MAIL)
         
-        if not user_found:
+        if not updated:
             raise HTTPException(status_code=404, detail="User account not found.")
 
         # 3. Delete the OTP
         session.delete(reset_record)
         session.commit()
+        invalidate_cached_user(request.email)
         
         return {"message": "Password updated successfully. You can now login."}
     
 
 # Verifying OTP
 @app.post("/auth/verify-otp-only", status_code=status.HTTP_200_OK, tags=["Auth"])
-async def verify_otp_only(request: OTPVerifyRequest):
+def verify_otp_only(request: OTPVerifyRequest):
     """
     Checks if OTP is valid without resetting password or deleting the OTP.
     Used for the frontend 'Next' button.
     """
     with Session(engine) as session:
-        statement = select(PasswordReset).where(
-            (PasswordReset.email == request.email) & 
-            (PasswordReset.otp == request.otp)
-        )
-        reset_record = session.exec(statement).first()
+        reset_record = session.exec(STMT_RESET_BY_EMAIL_OTP, params={"email": request.email, "otp": request.otp}).first()
 
         if not reset_record:
             raise HTTPException(status_code=400, detail="Invalid OTP Code.")
 
+        # Expired rows are left for the periodic purge (purge_expired_otps), no write here
         if reset_record.expires_at < datetime.utcnow():
-            session.delete(reset_record) # Cleanup expired
-            session.commit()
             raise HTTPException(status_code=400, detail="OTP has expired.")
             
         return {"message": "OTP is valid."}
@@ -1406,12 +1629,7 @@ def add_product_feedback(
 def get_product_reviews(product_id: int):
     with Session(engine) as session:
         # Join with Customer to get names
-        results = session.exec(
-            select(Feedback, Customer.name)
-            .join(Customer, Customer.id == Feedback.customer_id)
-            .where(Feedback.product_id == product_id)
-            .order_by(Feedback.created_at.desc())
-        ).all()
+        results = session.exec(STMT_FEEDBACK_BY_PRODUCT, params={"pid": product_id}).all()
         
         reviews = []
         for fb, c_name in results:
@@ -1427,13 +1645,7 @@ def get_product_reviews(product_id: int):
 def get_retailer_feedback(current_retailer: Retailer = Depends(get_current_retailer)):
     with Session(engine) as session:
         # Get feedback for ALL products owned by this retailer
-        results = session.exec(
-            select(Feedback, Product.name, Customer.name)
-            .join(Product, Product.id == Feedback.product_id)
-            .join(Customer, Customer.id == Feedback.customer_id)
-            .where(Product.retailer_id == current_retailer.id)
-            .order_by(Feedback.created_at.desc())
-        ).all()
+        results = session.exec(STMT_FEEDBACK_BY_RETAILER, params={"rid": current_retailer.id}).all()
         
         feedback_list = []
         for fb, p_name, c_name in results:
@@ -1470,17 +1682,46 @@ if not os.path.exists(product_images_dir):
     # Create it to prevent 500 errors, though images will be 404
     os.makedirs(product_images_dir, exist_ok=True)
 
-# 4. Mount Product Images BEFORE frontend
-# Maps http://localhost:8000/product_images/... -> backend/data/product_images/...
-app.mount("/product_images", StaticFiles(directory=product_images_dir), name="product_images")
-# ... existing product_images_dir logic ...
-profile_pictures_dir = os.path.join(base_dir, "../../frontend/assets/") # <--- Define path
+profile_pictures_dir = os.path.join(base_dir, "../../frontend/assets/")
 
-# ... existing product_images mount ...
-app.mount("/product_images", StaticFiles(directory=product_images_dir), name="product_images")
+# Where upload_profile_picture writes; created here once instead of on every upload
+profile_uploads_dir = os.path.join(base_dir, "../data/profile_pictures")
+os.makedirs(profile_uploads_dir, exist_ok=True)
 
-# --- ADD THIS LINE ---
-app.mount("/profile_pictures", StaticFiles(directory=profile_pictures_dir), name="profile_pictures")
+# 4. Mount Product Images and Profile Pictures BEFORE frontend (each mounted exactly once)
+# Maps http://localhost:8000/product_images/... -> backend/data/product_images/...
+# Behind Nginx, set STATIC_ACCEL_REDIRECT (e.g. "/_media") to let Nginx send the image bytes:
+# we only answer with an X-Accel-Redirect header pointing at its internal location (see README).
+STATIC_ACCEL_REDIRECT = os.getenv("STATIC_ACCEL_REDIRECT")
+
+# Image URLs rarely change content (uploads get fresh uuid names), so browsers may keep
+# them for a week and then revalidate with the ETag/Last-Modified StaticFiles already sends.
+# Not "immutable": re-running the seeder can reuse product ids, and with them {id}.jpg names.
+IMAGE_CACHE_CONTROL = os.getenv("IMAGE_CACHE_CONTROL", "public, max-age=604800")
+
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = IMAGE_CACHE_CONTROL
+        return response
+
+def accel_redirect_route(folder: str):
+    async def serve(file_path: str):
+        if ".." in file_path.split("/"):
+            raise HTTPException(status_code=404, detail="Not Found")
+        # Nginx keeps Cache-Control from this response when it serves the internal location
+        return Response(headers={
+            "X-Accel-Redirect": f"{STATIC_ACCEL_REDIRECT.rstrip('/')}/{folder}/{file_path}",
+            "Cache-Control": IMAGE_CACHE_CONTROL,
+        })
+    return serve
+
+if STATIC_ACCEL_REDIRECT:
+    app.add_api_route("/product_images/{file_path:path}", accel_redirect_route("product_images"), methods=["GET"], include_in_schema=False)
+    app.add_api_route("/profile_pictures/{file_path:path}", accel_redirect_route("profile_pictures"), methods=["GET"], include_in_schema=False)
+else:
+    app.mount("/product_images", CachedStaticFiles(directory=product_images_dir), name="product_images")
+    app.mount("/profile_pictures", CachedStaticFiles(directory=profile_pictures_dir), name="profile_pictures")
 
 # 5. Mount Frontend LAST (Catch-all)
 # Maps http://localhost:8000/... -> frontend/...
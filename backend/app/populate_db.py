@@ -2,8 +2,9 @@ import os
 import random
 import requests # pip install requests
 from sqlmodel import Session, select, delete
+from sqlalchemy import update, cast, String
 from db_models import Product, Category, Retailer
-from database import engine, create_db_and_tables, add_retailer, add_category, add_product
+from database import engine, create_db_and_tables, add_retailer, add_category, add_product, add_products_bulk
 from auth import hash_password
 
 # --- CONFIGURATION ---
@@ -92,20 +93,17 @@ def seed_manual_db():
         session.commit()
         
     # 2. Ensure Categories
+    # One session and one commit for all of them, instead of a commit per category
     print("Ensuring Categories exist...")
-    for name, cat_id in CATEGORY_IDS.items():
-        cat_img = get_category_url(name)
-        with Session(engine) as session:
+    with Session(engine) as session:
+        for name, cat_id in CATEGORY_IDS.items():
             existing = session.get(Category, cat_id)
             if not existing:
-                new_cat = Category(id=cat_id, name=name, description=f"All {name}", image_url=cat_img)
-                session.add(new_cat)
-                session.commit()
-            else:
-                if existing.name != name:
-                    existing.name = name
-                    session.add(existing)
-                    session.commit()
+                session.add(Category(id=cat_id, name=name, description=f"All {name}", image_url=get_category_url(name)))
+            elif existing.name != name:
+                existing.name = name
+                session.add(existing)
+        session.commit()
 
     # 3. Ensure Retailer
     with Session(engine) as session:
@@ -126,6 +124,7 @@ def seed_manual_db():
         
         generated_names = set()
         attempts = 0
+        rows = []
         
         while len(generated_names) < ITEMS_PER_CATEGORY:
             attempts += 1
@@ -154,26 +153,28 @@ def seed_manual_db():
             
             stock = 0 if random.random() < 0.08 else random.randint(5, 150)
             
-            with Session(engine) as session:
-                p = Product(
-                    name=name,
-                    description=f"High quality {name} in {cat_name} category.",
-                    category_id=cat_id,
-                    price=price,
-                    stock=stock,
-                    retailer_id=RETAILER_ID,
-                    image_url="" 
-                )
-                session.add(p)
-                session.commit()
-                session.refresh(p)
-                
-                p.image_url = f"product_images/{p.id}.jpg"
-                session.add(p)
-                session.commit()
-                
-                download_image(p.id, name)
-                
+            rows.append(dict(
+                name=name,
+                description=f"High quality {name} in {cat_name} category.",
+                category_id=cat_id,
+                price=price,
+                stock=stock,
+                retailer_id=RETAILER_ID,
+                image_url="" 
+            ))
+
+        # One batch INSERT per category, then point each row at its {id}.jpg in one UPDATE
+        ids = add_products_bulk(rows)
+        with Session(engine) as session:
+            session.exec(
+                update(Product)
+                .where(Product.id.in_(ids))
+                .values(image_url="product_images/" + cast(Product.id, String) + ".jpg")
+            )
+            session.commit()
+
+        for product_id, row in zip(ids, rows):
+            download_image(product_id, row["name"])
             total_created += 1
             if total_created % 20 == 0:
                 print(f" - Created {total_created} products total...")